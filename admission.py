@@ -0,0 +1,153 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from flask import g, current_app
+from metrics import Counter, Gauge, Histogram
+from timing import timed
+
+ADMISSION_RATE = float(os.environ.get('ADMISSION_RATE', 0))
+ADMISSION_BURST = int(os.environ.get('ADMISSION_BURST', 20))
+ADMISSION_MAX_HEAVY = int(os.environ.get('ADMISSION_MAX_HEAVY', 0))
+ADMISSION_QUEUE_TIMEOUT = float(
+    os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1.0))
+ADMISSION_MAX_SUBJECTS = int(os.environ.get('ADMISSION_MAX_SUBJECTS', 10000))
+
+# Admission control
+# Applied by require_permission once the token is verified. Each subject
+# (the sub claim) gets a token bucket of ADMISSION_RATE requests per
+# second, and at most ADMISSION_MAX_HEAVY heavy reads run at once. A heavy
+# read waits up to ADMISSION_QUEUE_TIMEOUT seconds for a slot. Both limits
+# are per worker.
+
+admission_total = Counter(
+    'admission_requests_total',
+    'Requests by admission outcome: admitted, queued (admitted after '
+    'waiting), rate_limited (429) or shed (503)',
+    ['outcome'])
+queue_seconds = Histogram(
+    'admission_queue_seconds', 'Time heavy reads waited for a slot')
+heavy_in_flight = Gauge(
+    'admission_heavy_in_flight', 'Heavy reads running in this worker')
+
+
+class AdmissionError(Exception):
+    def __init__(self, status_code, retry_after):
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token bucket per key, refilled at ``rate`` tokens per second up to
+    ``burst``. The least recently seen keys are dropped past
+    ``max_keys``."""
+
+    def __init__(self, rate, burst, max_keys=ADMISSION_MAX_SUBJECTS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Take a token for ``key``. Return 0 if one was available, or the
+        seconds until the next one."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class ConcurrencyLimiter:
+    """At most ``limit`` holders at once, the others wait up to
+    ``timeout`` seconds."""
+
+    def __init__(self, limit, timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.in_flight = 0
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return 'admitted' or 'queued', or None if no slot freed up in
+        time."""
+        outcome = 'admitted'
+        if not self._semaphore.acquire(blocking=False):
+            with timed('queue', queue_seconds):
+                if not self._semaphore.acquire(timeout=self.timeout):
+                    return None
+            outcome = 'queued'
+        with self._lock:
+            self.in_flight += 1
+        return outcome
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+
+class AdmissionController:
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST,
+                 max_heavy=ADMISSION_MAX_HEAVY,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.rate_limiter = RateLimiter(rate, burst) if rate else None
+        self.heavy = ConcurrencyLimiter(max_heavy, queue_timeout) \
+            if max_heavy else None
+
+    def admit(self, subject, heavy=False):
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.take(subject)
+            if wait:
+                admission_total.inc(outcome='rate_limited')
+                raise AdmissionError(429, math.ceil(wait))
+        outcome = 'admitted'
+        if heavy and self.heavy is not None:
+            outcome = self.heavy.acquire()
+            if outcome is None:
+                admission_total.inc(outcome='shed')
+                raise AdmissionError(
+                    503, max(1, math.ceil(self.heavy.timeout)))
+            # Released at teardown, after a streamed body is sent
+            g.admission_slot = self.heavy
+        admission_total.inc(outcome=outcome)
+
+
+def admit(payload, heavy=False):
+    """Admit the request of the verified token ``payload`` or raise
+    AdmissionError. Called by require_permission."""
+    controller = current_app.extensions.get('admission')
+    if controller is not None:
+        controller.admit(payload.get('sub'), heavy)
+
+
+def init_admission(app):
+    controller = AdmissionController(
+        rate=app.config.get('ADMISSION_RATE', ADMISSION_RATE),
+        burst=app.config.get('ADMISSION_BURST', ADMISSION_BURST),
+        max_heavy=app.config.get('ADMISSION_MAX_HEAVY', ADMISSION_MAX_HEAVY),
+        queue_timeout=app.config.get(
+            'ADMISSION_QUEUE_TIMEOUT', ADMISSION_QUEUE_TIMEOUT))
+    if controller.rate_limiter is None and controller.heavy is None:
+        return
+    app.extensions['admission'] = controller
+    if controller.heavy is not None:
+        heavy_in_flight.set_function(
+            lambda: {(): controller.heavy.in_flight})
+
+    @app.teardown_request
+    def release_admission_slot(error):
+        slot = g.pop('admission_slot', None)
+        if slot is not None:
+            slot.release()
@@ -1,141 +1,419 @@
 import os
-from flask import Flask, jsonify, request, abort
-from models import setup_db, Actor, Movie
+import hmac
+from flask import Flask, request, abort, Response
+from models import (
+    setup_db, insert_rows, update_rows, delete_rows, get_cast,
+    get_filmography, add_cast, remove_cast, Actor, Movie
+)
 from flask_cors import CORS
 from auth import require_permission, AuthError
-
-
-def format_data(d):
-    return [data.format() for data in d]
+from metrics import REGISTRY
+from timing import init_timing
+from fastjson import init_json, jsonify
+from profiler import init_profiler, profile_store
+from compression import init_compression
+from groupcommit import (init_group_commit, insert_one, update_one,
+                         GroupCommitTimeout)
+from admission import init_admission, AdmissionError
+from changes import init_changes, stream_changes
+from bulk import (
+    get_bulk_rows, bulk_created, get_bulk_body, get_bulk_criteria
+)
+from listing import (
+    conditional, fetch_page, fetch_changes, format_data, stream_collection,
+    wants_changes, wants_stream
+)
 
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    app.config.from_mapping(test_config or {})
     setup_db(app)
     CORS(app)
+    init_json(app)
+    init_timing(app)
+    init_profiler(app)
+    init_compression(app)
+    init_group_commit(app)
+    init_admission(app)
+    init_changes(app)
 
     # Actors endpoints
     @app.route('/actors')
-    @require_permission('read:information')
+    @require_permission('read:information', heavy=True)
+    @conditional(Actor)
     def get_actors(payload):
-        query = Actor.query.all()
+        if wants_changes():
+            actors, deleted, since, more = fetch_changes(Actor)
+            return jsonify({
+                'actors': actors,
+                'deleted': deleted,
+                'since': since,
+                'more': more,
+                'success': True
+            })
+        if wants_stream():
+            return stream_collection(Actor, 'actors')
+
+        actors, next_cursor = fetch_page(Actor)
 
         return jsonify({
-            'actors': format_data(query),
+            'actors': actors,
+            'next': next_cursor,
             'success': True
         })
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @require_permission('delete:actor')
     def delete_actor(payload, actor_id):
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
         try:
-            actor.delete()
+            ids = delete_rows(Actor, [Actor.id == actor_id])
         except Exception:
+            abort(422)
+        if not ids:
             abort(404)
 
         return jsonify({
-            'id': actor.id,
+            'id': actor_id,
             'success': True
         })
 
     @app.route('/actors', methods=['POST'])
     @require_permission('create:actor')
     def add_actor(payload):
-        req = request.get_json()
-        actor = Actor(name=req['name'], age=req['age'], gender=req['gender'])
         try:
-            actor.insert()
+            values = Actor.validate(request.get_json())
+        except ValueError:
+            abort(422)
+        try:
+            actor_id = insert_one(Actor, values)
+        except GroupCommitTimeout:
+            abort(503)
         except Exception:
             abort(422)
 
         return jsonify({
-            'id': actor.id,
+            'id': actor_id,
+            'success': True
+        })
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @require_permission('create:actor')
+    def add_actors(payload):
+        count, rows, errors = get_bulk_rows(Actor)
+        try:
+            ids = insert_rows(Actor, [values for index, values in rows])
+        except Exception:
+            abort(422)
+
+        return bulk_created(count, rows, ids, errors)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @require_permission('update:actor')
+    def update_actors_in_bulk(payload):
+        body = get_bulk_body()
+        criteria = get_bulk_criteria(Actor, body)
+        try:
+            values = Actor.validate(body.get('values'), partial=True)
+        except ValueError:
+            abort(422)
+        if not values:
+            abort(422)
+        try:
+            ids = update_rows(Actor, values, criteria)
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'ids': ids,
+            'success': True
+        })
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @require_permission('delete:actor')
+    def delete_actors_in_bulk(payload):
+        criteria = get_bulk_criteria(Actor, get_bulk_body())
+        try:
+            ids = delete_rows(Actor, criteria)
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'ids': ids,
             'success': True
         })
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @require_permission('update:actor')
     def update_actors(payload, actor_id):
-        req = request.get_json()
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        if 'name' in req:
-            actor.name = req['name']
-        if 'age' in req:
-            actor.age = req['age']
-        if 'gender' in req:
-            actor.gender = req['gender']
-        try:
-            actor.update()
+        try:
+            values = Actor.validate(request.get_json(), partial=True)
+        except ValueError:
+            abort(422)
+        if not values:
+            abort(422)
+        try:
+            ids = update_one(Actor, values, [Actor.id == actor_id])
+        except GroupCommitTimeout:
+            abort(503)
         except Exception:
             abort(422)
+        if not ids:
+            abort(404)
 
         return jsonify({
-            'id': actor.id,
+            'id': actor_id,
+            'success': True
+        })
+
+    @app.route('/actors/<int:actor_id>/movies')
+    @require_permission('read:information')
+    def get_actor_movies(payload, actor_id):
+        movies = get_filmography(actor_id)
+        if movies is None:
+            abort(404)
+
+        return jsonify({
+            'id': actor_id,
+            'movies': format_data(movies),
             'success': True
         })
 
     # Movies endpoints
     @app.route('/movies')
-    @require_permission('read:information')
+    @require_permission('read:information', heavy=True)
+    @conditional(Movie)
     def get_movies(payload):
-        query = Movie.query.all()
+        if wants_changes():
+            movies, deleted, since, more = fetch_changes(Movie)
+            return jsonify({
+                'movies': movies,
+                'deleted': deleted,
+                'since': since,
+                'more': more,
+                'success': True
+            })
+        if wants_stream():
+            return stream_collection(Movie, 'movies')
+
+        movies, next_cursor = fetch_page(Movie)
 
         return jsonify({
-            'movies': format_data(query),
+            'movies': movies,
+            'next': next_cursor,
             'success': True
         })
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @require_permission('delete:movie')
     def delete_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
         try:
-            movie.delete()
+            ids = delete_rows(Movie, [Movie.id == movie_id])
         except Exception:
+            abort(422)
+        if not ids:
             abort(404)
 
         return jsonify({
-            'id': movie.id,
+            'id': movie_id,
             'success': True
         })
 
     @app.route('/movies', methods=['POST'])
     @require_permission('create:movie')
     def add_movie(payload):
-        req = request.get_json()
-        movie = Movie(title=req['title'], release_date=req['release_date'])
         try:
-            movie.insert()
+            values = Movie.validate(request.get_json())
+        except ValueError:
+            abort(422)
+        try:
+            movie_id = insert_one(Movie, values)
+        except GroupCommitTimeout:
+            abort(503)
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'id': movie_id,
+            'success': True
+        })
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @require_permission('create:movie')
+    def add_movies(payload):
+        count, rows, errors = get_bulk_rows(Movie)
+        try:
+            ids = insert_rows(Movie, [values for index, values in rows])
+        except Exception:
+            abort(422)
+
+        return bulk_created(count, rows, ids, errors)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @require_permission('update:movie')
+    def update_movies_in_bulk(payload):
+        body = get_bulk_body()
+        criteria = get_bulk_criteria(Movie, body)
+        try:
+            values = Movie.validate(body.get('values'), partial=True)
+        except ValueError:
+            abort(422)
+        if not values:
+            abort(422)
+        try:
+            ids = update_rows(Movie, values, criteria)
         except Exception:
             abort(422)
 
         return jsonify({
-            'id': movie.id,
+            'ids': ids,
+            'success': True
+        })
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @require_permission('delete:movie')
+    def delete_movies_in_bulk(payload):
+        criteria = get_bulk_criteria(Movie, get_bulk_body())
+        try:
+            ids = delete_rows(Movie, criteria)
+        except Exception:
+            abort(422)
+
+        return jsonify({
+            'ids': ids,
             'success': True
         })
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @require_permission('update:movie')
     def update_movie(payload, movie_id):
-        req = request.get_json()
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        if 'title' in req:
-            movie.title = req['title']
-        if 'release_date' in req:
-            movie.release_date = req['release_date']
-        try:
-            movie.update()
+        try:
+            values = Movie.validate(request.get_json(), partial=True)
+        except ValueError:
+            abort(422)
+        if not values:
+            abort(422)
+        try:
+            ids = update_one(Movie, values, [Movie.id == movie_id])
+        except GroupCommitTimeout:
+            abort(503)
         except Exception:
             abort(422)
+        if not ids:
+            abort(404)
 
         return jsonify({
-            'id': movie.id,
+            'id': movie_id,
             'success': True
         })
 
+    # Cast endpoints
+    @app.route('/movies/<int:movie_id>/cast')
+    @require_permission('read:information')
+    def get_movie_cast(payload, movie_id):
+        cast = get_cast(movie_id)
+        if cast is None:
+            abort(404)
+
+        return jsonify({
+            'id': movie_id,
+            'cast': format_data(cast),
+            'success': True
+        })
+
+    @app.route('/movies/<int:movie_id>/cast', methods=['POST'])
+    @require_permission('update:movie')
+    def add_movie_cast(payload, movie_id):
+        req = request.get_json(silent=True) or {}
+        actor_ids = req.get('actor_ids')
+        if (not isinstance(actor_ids, list) or not actor_ids or
+                any(isinstance(id, bool) or not isinstance(id, int)
+                    for id in actor_ids)):
+            abort(422)
+        try:
+            added = add_cast(movie_id, actor_ids)
+        except Exception:
+            abort(422)
+        if added is None:
+            abort(404)
+
+        return jsonify({
+            'id': movie_id,
+            'actor_ids': added,
+            'success': True
+        })
+
+    @app.route('/movies/<int:movie_id>/cast/<int:actor_id>',
+               methods=['DELETE'])
+    @require_permission('update:movie')
+    def delete_movie_cast(payload, movie_id, actor_id):
+        try:
+            removed = remove_cast(movie_id, actor_id)
+        except Exception:
+            abort(422)
+        if not removed:
+            abort(404)
+
+        return jsonify({
+            'id': movie_id,
+            'actor_id': actor_id,
+            'success': True
+        })
+
+    # Change feed endpoint
+    @app.route('/changes')
+    @require_permission('read:information')
+    def get_changes(payload):
+        return stream_changes(request.headers.get('Last-Event-ID') or
+                              request.args.get('last_event_id'))
+
+    # Metrics endpoint
+    @app.route('/metrics')
+    def metrics():
+        # Open to anyone unless METRICS_TOKEN is set
+        metrics_token = os.environ.get('METRICS_TOKEN')
+        if metrics_token and not hmac.compare_digest(
+                request.headers.get('Authorization', '').encode(),
+                ('Bearer ' + metrics_token).encode()):
+            raise AuthError({
+                "code": "invalid_header",
+                "description": "Metrics token is expected"
+            }, 401)
+
+        return Response(REGISTRY.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    # Profiles endpoints
+    @app.route('/profiles')
+    @require_permission('read:profiles')
+    def get_profiles(payload):
+        return jsonify({
+            'profiles': profile_store.list(),
+            'success': True
+        })
+
+    @app.route('/profiles/<profile_id>')
+    @require_permission('read:profiles')
+    def download_profile(payload, profile_id):
+        profile = profile_store.get(profile_id)
+        if profile is None:
+            abort(404)
+
+        response = Response(profile['data'], mimetype=profile['mimetype'])
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=%s.%s' % (profile['id'], profile['format'])
+        return response
+
     # Error handler
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            'code': 400,
+            'description': 'bad request',
+            'success': False
+        }), 400
+
     @app.errorhandler(404)
     def resource_not_found(error):
         return jsonify({
@@ -144,6 +422,22 @@ def create_app(test_config=None):
             'success': False
         }), 404
 
+    @app.errorhandler(410)
+    def resync_required(error):
+        return jsonify({
+            'code': 410,
+            'description': 'resync required',
+            'success': False
+        }), 410
+
+    @app.errorhandler(413)
+    def request_too_large(error):
+        return jsonify({
+            'code': 413,
+            'description': 'request entity too large',
+            'success': False
+        }), 413
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -160,13 +454,28 @@ def create_app(test_config=None):
             'success': False
         }), 500
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            'code': 503,
+            'description': 'service unavailable',
+            'success': False
+        }), 503
+
+    @app.errorhandler(AdmissionError)
+    def admission_error(error):
+        return jsonify({
+            'code': error.status_code,
+            'description': 'too many requests' if error.status_code == 429
+            else 'service unavailable',
+            'success': False
+        }), error.status_code, {'Retry-After': str(error.retry_after)}
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         return jsonify(error.error), error.status_code
     return app
 
 
-app = create_app()
-
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
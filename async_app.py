@@ -0,0 +1,11 @@
+# Cooperative (gevent) entry point, serve with:
+#   gunicorn -k gevent --worker-connections 1000 async_app:app
+# Blocking socket calls, including the psycopg2 driver and the JWKS fetch,
+# yield to other requests instead of holding the worker.
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+patch_psycopg()
+
+from wsgi import app  # noqa: E402,F401
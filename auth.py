@@ -1,13 +1,30 @@
+import os
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from jose import jwt
 from flask import request, _request_ctx_stack
 from functools import wraps
 from urllib.request import urlopen
+from timing import timed, auth_seconds, jwks_fetch_seconds
+from profiler import profile_permitted
+from admission import admit
 
 AUTH0_DOMAIN = 'dev-9dxdz39b.auth0.com'
 API_AUDIENCE = 'fsnd-capstone'
 ALGORITHMS = ["RS256"]
 
+# JWKS source can be an https:// or file:// URL or a local path
+JWKS_URL = os.environ.get(
+    'JWKS_URL', "https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_REFRESH_AHEAD = int(os.environ.get('JWKS_REFRESH_AHEAD', 300))
+JWKS_MIN_REFETCH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+
 # Auth error handler
 
 
@@ -47,20 +64,140 @@ def get_token_auth_header():
     return token
 
 
+# JWKS key store
+
+
+class JWKSKeyStore:
+    """Signing keys fetched once, indexed by kid and refreshed in the
+    background before they go stale."""
+
+    def __init__(self, source, ttl=JWKS_TTL,
+                 refresh_ahead=JWKS_REFRESH_AHEAD,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 timeout=5):
+        self.source = source
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._next_refresh = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+
+    def _read(self):
+        if '://' in self.source:
+            with urlopen(self.source, timeout=self.timeout) as jsonurl:
+                return json.loads(jsonurl.read())
+        with open(self.source) as f:
+            return json.load(f)
+
+    def refresh(self, stale_before=None):
+        with self._lock:
+            # Another thread may have refreshed, or failed to, while we
+            # waited for the lock
+            if (stale_before is not None and self._last_attempt is not None
+                    and self._last_attempt > stale_before):
+                return
+            now = time.monotonic()
+            self._last_attempt = now
+            try:
+                with timed('jwks', jwks_fetch_seconds):
+                    jwks = self._read()
+            except Exception:
+                self._next_refresh = now + self.min_refetch_interval
+                raise
+            self._keys = {
+                key["kid"]: {
+                    "kty": key["kty"],
+                    "kid": key["kid"],
+                    "use": key["use"],
+                    "n": key["n"],
+                    "e": key["e"]
+                }
+                for key in jwks["keys"] if "kid" in key
+            }
+            self._fetched_at = now
+            self._next_refresh = now + self.ttl - self.refresh_ahead
+        self._ensure_refresher()
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        if self._fetched_at is None:
+            # Until the keys can be fetched, tokens are refused with a 401,
+            # and the fetch is retried at most every min_refetch_interval
+            if self._next_refresh is not None and now < self._next_refresh:
+                return None
+            try:
+                self.refresh(stale_before=now)
+            except Exception:
+                return None
+        elif now - self._fetched_at > self.ttl:
+            # The background refresher fell behind. Refresh inline, but keep
+            # serving the old keys if the source is unreachable.
+            try:
+                self.refresh(stale_before=now - self.ttl)
+            except Exception:
+                pass
+        self._ensure_refresher()
+
+        key = self._keys.get(kid)
+        if key is None and kid is not None and self._may_refetch():
+            # Unknown kid, the keys may have been rotated. An unreachable
+            # source leaves it unknown, the token is then refused with a 401.
+            try:
+                self.refresh(stale_before=now)
+            except Exception:
+                return None
+            key = self._keys.get(kid)
+        return key
+
+    def _may_refetch(self):
+        last = self._last_attempt
+        return (last is None or
+                time.monotonic() - last >= self.min_refetch_interval)
+
+    def _ensure_refresher(self):
+        # Threads do not survive fork, so a forked worker starts its own
+        pid = os.getpid()
+        if self._refresher_pid == pid and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher_pid == pid and self._refresher.is_alive():
+                return
+            self._refresher = threading.Thread(
+                target=self._refresh_loop, name='jwks-refresh', daemon=True)
+            self._refresher_pid = pid
+            self._refresher.start()
+
+    def reset(self):
+        """Forget the lock and the refresher thread inherited from the
+        parent of a forked process. The keys are kept."""
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+
+    def _refresh_loop(self):
+        while True:
+            next_refresh = self._next_refresh
+            if next_refresh is None:
+                next_refresh = time.monotonic() + self.min_refetch_interval
+            time.sleep(max(next_refresh - time.monotonic(), 1))
+            try:
+                self.refresh()
+            except Exception:
+                pass
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen("https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
+    rsa_key = jwks_store.get_key(unverified_header.get("kid"))
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -94,8 +231,84 @@ def verify_decode_jwt(token):
         }, 401)
 
 
-def check_permission(permission, payload):
-    permissions = payload['permissions']
+# Verified token cache
+
+
+class TokenCache:
+    """Bounded LRU of verified tokens keyed by a hash of the token. Entries
+    expire at the token's exp claim."""
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, permissions, exp = entry
+            if exp <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    def set(self, token, payload):
+        permissions = frozenset(payload.get('permissions') or ())
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return permissions
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, permissions, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return permissions
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+token_cache = TokenCache()
+
+
+def get_verified_claims(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+    with timed('jwt', auth_seconds, step='verify_decode_jwt'):
+        payload = verify_decode_jwt(token)
+    return payload, token_cache.set(token, payload)
+
+
+def check_permission(permission, payload, permissions=None):
+    if permissions is None:
+        permissions = payload['permissions']
 
     if not permissions:
         raise AuthError({
@@ -111,13 +324,20 @@ def check_permission(permission, payload):
     return True
 
 
-def require_permission(permission=''):
+def require_permission(permission='', heavy=False):
+    """Verify the bearer token, check ``permission`` and admit the
+    request. ``heavy`` reads count against ADMISSION_MAX_HEAVY."""
     def require_permission_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permission(permission, payload)
+            with timed('auth_header', auth_seconds,
+                       step='get_token_auth_header'):
+                token = get_token_auth_header()
+            payload, permissions = get_verified_claims(token)
+            with timed('permission', auth_seconds, step='check_permission'):
+                check_permission(permission, payload, permissions)
+            admit(payload, heavy)
+            profile_permitted(permissions)
             return f(payload, *args, **kwargs)
         return wrapper
     return require_permission_decorator
@@ -0,0 +1,48 @@
+"""Compare the sync and the gevent (async_app) serving modes.
+
+Starts gunicorn once per mode against DATABASE_URL, sends --requests GET
+requests with --concurrency clients in flight and prints throughput and
+latency percentiles. Tokens are minted by a local issuer.
+
+    $ python -m benchmarks.async_vs_sync --concurrency 200 --path /actors
+"""
+import os
+import argparse
+from benchmarks.tokens import setup_environment
+from benchmarks.load import serve, run_load
+
+MODES = {
+    'sync': ('wsgi:app', ['-k', 'sync']),
+    'gevent': ('async_app:app',
+               ['-k', 'gevent', '--worker-connections', '1000'])
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--path', default='/actors')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=list(MODES))
+    args = parser.parse_args()
+    setup_environment()
+    token = os.environ['CASTING_ASSISTANT']
+
+    print('%-8s %10s %8s %8s %8s %8s' % (
+        'mode', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for mode in args.modes:
+        app, options = MODES[mode]
+        with serve(app, args.workers, options) as url:
+            result = run_load(url, [args.path], token, args.requests,
+                              args.concurrency, args.processes)
+        result = result['GET ' + args.path]
+        print('%-8s %10.1f %8.1f %8.1f %8.1f %8d' % (
+            mode, result['throughput'], result['p50'] * 1000,
+            result['p95'] * 1000, result['p99'] * 1000, result['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Measure the cold start time of the app.
+
+Times the import of the app in a fresh interpreter, then the time from
+starting gunicorn to the first successful GET --path, with and without
+preload_app and DB_CREATE_ALL.
+
+    $ python -m benchmarks.cold_start --repeat 5
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from urllib.error import URLError, HTTPError
+from urllib.request import Request, urlopen
+from benchmarks.tokens import setup_environment
+from benchmarks.common import (ROOT, GUNICORN, free_port, summarize,
+                               add_baseline_args, report)
+
+IMPORT = ('import time; start = time.perf_counter(); import wsgi; '
+          'print(time.perf_counter() - start)')
+MODES = {
+    'preload': {'GUNICORN_PRELOAD': 'true', 'DB_CREATE_ALL': 'false'},
+    'no preload': {'GUNICORN_PRELOAD': 'false', 'DB_CREATE_ALL': 'false'},
+    'preload + create_all': {'GUNICORN_PRELOAD': 'true',
+                             'DB_CREATE_ALL': 'true'}
+}
+
+
+def import_time():
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT], cwd=ROOT)
+    return float(output.decode().split()[-1])
+
+
+def first_request_time(env, path, token, workers, timeout=60):
+    port = free_port()
+    url = 'http://127.0.0.1:%d%s' % (port, path)
+    request = Request(url, headers={'Authorization': 'Bearer ' + token})
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        GUNICORN + ['--workers', str(workers),
+                    '--bind', '127.0.0.1:%d' % port,
+                    '--log-level', 'warning', 'wsgi:app'],
+        cwd=ROOT, env=dict(os.environ, **env))
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urlopen(request, timeout=5) as r:
+                    r.read()
+                    return time.perf_counter() - start
+            except HTTPError as e:
+                raise RuntimeError('%s returned %d' % (path, e.code))
+            except (URLError, OSError):
+                time.sleep(0.01)
+        raise RuntimeError('no response within %ds' % timeout)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--path', default='/actors')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    add_baseline_args(parser)
+    args = parser.parse_args()
+    setup_environment()
+    token = os.environ['CASTING_ASSISTANT']
+
+    timings = [import_time() for i in range(args.repeat)]
+    results = {'import wsgi': summarize(timings, sum(timings))}
+    for name, env in MODES.items():
+        timings = [first_request_time(env, args.path, token, args.workers)
+                   for i in range(args.repeat)]
+        results['first request, ' + name] = summarize(
+            timings, sum(timings))
+    return report(args, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
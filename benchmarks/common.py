@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import socket
+from urllib.error import URLError, HTTPError
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, 'benchmarks', 'baselines')
+GUNICORN = [sys.executable, '-c',
+            'from gunicorn.app.wsgiapp import run; run()']
+
+# Helpers shared by the benchmarks
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urlopen(url, timeout=1)
+            return
+        except HTTPError:
+            return
+        except (URLError, OSError):
+            time.sleep(0.1)
+    raise RuntimeError('server did not start: ' + url)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def summarize(latencies, elapsed, errors=0):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99)
+    }
+
+
+def print_results(results, baseline=None):
+    print('%-36s %10s %9s %9s %9s %7s' % (
+        'benchmark', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for name, result in results.items():
+        print('%-36s %10.1f %9.3f %9.3f %9.3f %7d' % (
+            name, result['throughput'], result['p50'] * 1000,
+            result['p95'] * 1000, result['p99'] * 1000, result['errors']))
+        old = (baseline or {}).get(name)
+        if old:
+            print('%-36s %9.1f%% %8.1f%% %8.1f%% %8.1f%%' % (
+                '  vs baseline', change(old, result, 'throughput'),
+                change(old, result, 'p50'), change(old, result, 'p95'),
+                change(old, result, 'p99')))
+
+
+def change(old, new, key):
+    if not old[key]:
+        return 0.0
+    return (new[key] - old[key]) / old[key] * 100
+
+
+# Baselines
+
+
+def baseline_path(name):
+    if os.sep in name or name.endswith('.json'):
+        return name
+    return os.path.join(BASELINE_DIR, name + '.json')
+
+
+def save_baseline(name, results):
+    path = baseline_path(name)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'results': results}, f, indent=2, sort_keys=True)
+    print('baseline saved to ' + path)
+
+
+def load_baseline(name):
+    with open(baseline_path(name)) as f:
+        return json.load(f)['results']
+
+
+def regressions(baseline, results, tolerance):
+    """Return the names of the benchmarks whose p95 latency or throughput
+    is worse than the baseline by more than ``tolerance`` (a fraction)."""
+    slower = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        if result['p95'] > old['p95'] * (1 + tolerance) or \
+                result['throughput'] < old['throughput'] * (1 - tolerance):
+            slower.append(name)
+    return slower
+
+
+def add_baseline_args(parser):
+    parser.add_argument('--save', metavar='NAME',
+                        help='save the results as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME',
+                        help='compare the results with baseline NAME')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown before --compare fails '
+                             '(default 0.1, i.e. 10%%)')
+
+
+def report(args, results):
+    """Print ``results``, save or compare them as the command line asks,
+    and return the exit status."""
+    baseline = load_baseline(args.compare) if args.compare else None
+    print_results(results, baseline)
+    if args.save:
+        save_baseline(args.save, results)
+    if baseline is not None:
+        slower = regressions(baseline, results, args.tolerance)
+        if slower:
+            print('regressions: ' + ', '.join(slower))
+            return 1
+    return 0
@@ -0,0 +1,70 @@
+"""CPU cost against bytes saved of the response encodings.
+
+Fetches listing payloads from the app in-process (an empty DATABASE_URL
+is seeded first) and compresses each with every encoding and level.
+
+    $ python -m benchmarks.compression --gzip-levels 1 6 9 --br-levels 1 4 11
+"""
+import os
+import sys
+import argparse
+from benchmarks.tokens import setup_environment
+from benchmarks.common import add_baseline_args, report
+from benchmarks.micro import measure
+
+PAYLOADS = [
+    '/actors?limit=1000',
+    '/movies?limit=1000',
+    '/movies?include=cast&limit=1000',
+    '/actors?stream=1'
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--gzip-levels', type=int, nargs='+',
+                        default=[1, 6, 9])
+    parser.add_argument('--br-levels', type=int, nargs='+',
+                        default=[1, 4, 6])
+    add_baseline_args(parser)
+    args = parser.parse_args()
+
+    setup_environment()
+    os.environ['RESPONSE_CACHE_SIZE'] = '0'
+    from app import create_app
+    from models import Actor
+    from compression import ENCODERS, compress
+    from benchmarks.seed import seed
+
+    app = create_app({'DB_CREATE_ALL': True})
+    with app.app_context():
+        if Actor.query.first() is None:
+            seed(10000, 10000, cast=3)
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + os.environ['CASTING_ASSISTANT']}
+    payloads = {path: client.get(path, headers=headers).data
+                for path in PAYLOADS}
+
+    levels = [('gzip', level) for level in args.gzip_levels]
+    if 'br' in ENCODERS:
+        levels += [('br', level) for level in args.br_levels]
+
+    print('%-36s %-8s %12s %12s %7s' % (
+        'payload', 'encoding', 'bytes', 'compressed', 'ratio'))
+    results = {}
+    for path, data in payloads.items():
+        for encoding, level in levels:
+            size = len(compress(data, encoding, level))
+            print('%-36s %-8s %12d %12d %6.1fx' % (
+                path, '%s-%d' % (encoding, level), len(data), size,
+                len(data) / size))
+            results['%s-%d %s' % (encoding, level, path)] = measure(
+                lambda: compress(data, encoding, level), args.iterations,
+                warmup=2)
+    print()
+    return report(args, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
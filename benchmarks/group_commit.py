@@ -0,0 +1,72 @@
+"""Compare one commit per write with group commit.
+
+Sends --requests POST /actors from --concurrency threads to the app
+in-process, once per mode, against DATABASE_URL. Group commit only pays
+off when a worker serves concurrent requests (threads or gevent), which
+is what the threads stand in for here.
+
+    $ python -m benchmarks.group_commit --concurrency 32 --requests 2000
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.tokens import setup_environment
+from benchmarks.common import summarize, add_baseline_args, report
+
+MODES = {
+    'single commit': {'GROUP_COMMIT': False},
+    'group commit': {'GROUP_COMMIT': True}
+}
+
+
+def run_writes(app, requests, concurrency):
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + os.environ['CASTING_DIRECTOR']}
+
+    def post(i):
+        start = time.perf_counter()
+        res = client.post('/actors', headers=headers, json={
+            'name': 'Benchmark %d' % i, 'age': 40, 'gender': 'Other'})
+        return time.perf_counter() - start, res.status_code == 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(post, range(requests)))
+    elapsed = time.perf_counter() - start
+    return summarize([latency for latency, ok in results], elapsed,
+                     errors=sum(1 for latency, ok in results if not ok))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--interval-ms', type=float, default=5)
+    parser.add_argument('--max-rows', type=int, default=100)
+    add_baseline_args(parser)
+    args = parser.parse_args()
+
+    setup_environment()
+    from app import create_app
+    from models import db, Actor
+
+    results = {}
+    for name, config in MODES.items():
+        app = create_app(dict(config, DB_CREATE_ALL=True))
+        committer = app.extensions.get('group_commit')
+        if committer is not None:
+            committer.interval = args.interval_ms / 1000
+            committer.max_rows = args.max_rows
+        results['POST /actors, ' + name] = run_writes(
+            app, args.requests, args.concurrency)
+        with app.app_context():
+            Actor.query.filter(Actor.name.like('Benchmark %')).delete(
+                synchronize_session=False)
+            db.session.commit()
+    return report(args, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
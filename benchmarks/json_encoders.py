@@ -0,0 +1,59 @@
+"""Compare Flask's default jsonify with the fastjson backends.
+
+Encodes one listing page of formatted movies (--rows of them) per
+iteration, and checks that the backends produce the same bytes first.
+
+    $ python -m benchmarks.json_encoders --rows 1000
+"""
+import sys
+import argparse
+import datetime
+from flask import Flask, jsonify as flask_jsonify
+from benchmarks.common import add_baseline_args, report
+from benchmarks.micro import measure
+import fastjson
+
+
+def page(rows):
+    first = datetime.date(1950, 1, 1)
+    return {
+        'movies': [{
+            'id': i + 1,
+            'title': 'Movie %d' % i,
+            'release_date': first + datetime.timedelta(days=i)
+        } for i in range(rows)],
+        'next': rows,
+        'success': True
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=500)
+    add_baseline_args(parser)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    data = page(args.rows)
+    backends = [fastjson.StdlibBackend()]
+    if fastjson.orjson is not None:
+        backends.append(fastjson.OrjsonBackend())
+    outputs = {backend.name: backend.dumps(data) for backend in backends}
+    if len(set(outputs.values())) != 1:
+        print('backends disagree: ' + ', '.join(outputs))
+        return 1
+
+    results = {}
+    with app.app_context():
+        results['flask.jsonify'] = measure(
+            lambda: flask_jsonify(data), args.iterations)
+        for backend in backends:
+            fastjson.backend = backend
+            results['fastjson.jsonify (%s)' % backend.name] = measure(
+                lambda: fastjson.jsonify(data), args.iterations)
+    return report(args, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
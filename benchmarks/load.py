@@ -0,0 +1,127 @@
+"""HTTP load driver with several client processes.
+
+Starts gunicorn against DATABASE_URL with tokens from a local issuer, or
+targets a running server with --url (export the tokens of
+benchmarks.tokens to both). The requests are spread over --path in turn
+and over --processes client processes, each with its share of
+--concurrency threads.
+
+    $ python -m benchmarks.load --workers 4 --path /actors --path /movies
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from contextlib import contextmanager
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError, HTTPError
+from urllib.request import Request, urlopen
+from benchmarks.tokens import setup_environment
+from benchmarks.common import (ROOT, GUNICORN, free_port, wait_until_up,
+                               summarize, add_baseline_args, report)
+
+
+@contextmanager
+def serve(app='wsgi:app', workers=2, options=()):
+    """Run gunicorn on a free port and yield its base URL."""
+    port = free_port()
+    server = subprocess.Popen(
+        GUNICORN + ['--workers', str(workers),
+                    '--bind', '127.0.0.1:%d' % port,
+                    '--log-level', 'warning'] + list(options) + [app],
+        cwd=ROOT)
+    try:
+        url = 'http://127.0.0.1:%d' % port
+        wait_until_up(url + '/metrics')
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def client(job):
+    """Send the requests of one client process, return their paths,
+    latencies and outcome along with the wall clock bounds."""
+    url, paths, token, requests, threads = job
+    headers = {'Authorization': 'Bearer ' + token}
+
+    def fetch(path):
+        start = time.perf_counter()
+        try:
+            with urlopen(Request(url + path, headers=headers),
+                         timeout=60) as r:
+                r.read()
+                ok = r.status == 200
+        except (HTTPError, URLError, OSError):
+            ok = False
+        return path, time.perf_counter() - start, ok
+
+    started = time.time()
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(
+            fetch, (paths[i % len(paths)] for i in range(requests))))
+    return started, time.time(), results
+
+
+def run_load(url, paths, token, requests, concurrency, processes=1):
+    processes = max(1, min(processes, concurrency))
+    jobs = [(url, paths, token,
+             requests // processes + (i < requests % processes),
+             concurrency // processes + (i < concurrency % processes))
+            for i in range(processes)]
+    if processes == 1:
+        outcomes = [client(jobs[0])]
+    else:
+        with Pool(processes) as pool:
+            outcomes = pool.map(client, jobs)
+
+    elapsed = max(end for _, end, _ in outcomes) - \
+        min(start for start, _, _ in outcomes)
+    results = [result for _, _, rs in outcomes for result in rs]
+    summary = {}
+    for path in paths:
+        latencies = [latency for p, latency, ok in results if p == path]
+        errors = sum(1 for p, latency, ok in results if p == path and not ok)
+        summary['GET ' + path] = summarize(latencies, elapsed, errors)
+    if len(paths) > 1:
+        summary['all'] = summarize(
+            [latency for p, latency, ok in results], elapsed,
+            sum(1 for p, latency, ok in results if not ok))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='base URL of a running server')
+    parser.add_argument('--path', action='append',
+                        help='path to request, may be repeated '
+                             '(default /actors)')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='client processes')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn workers')
+    parser.add_argument('--app', default='wsgi:app')
+    parser.add_argument('--role', default='CASTING_ASSISTANT')
+    add_baseline_args(parser)
+    args, gunicorn_options = parser.parse_known_args()
+    paths = args.path or ['/actors']
+
+    if args.url:
+        token = os.environ[args.role]
+        results = run_load(args.url, paths, token, args.requests,
+                           args.concurrency, args.processes)
+    else:
+        setup_environment()
+        token = os.environ[args.role]
+        with serve(args.app, args.workers, gunicorn_options) as url:
+            results = run_load(url, paths, token, args.requests,
+                               args.concurrency, args.processes)
+    return report(args, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
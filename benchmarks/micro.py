@@ -0,0 +1,140 @@
+"""Micro-benchmarks of token verification, serialization and every route.
+
+Runs in-process against DATABASE_URL with tokens from a local issuer, so
+no Auth0 tenant is needed. An empty database is seeded first. Set
+RESPONSE_CACHE_SIZE=0 to measure the reads without the response cache.
+
+    $ python -m benchmarks.micro --save before
+    $ python -m benchmarks.micro --compare before
+"""
+import os
+import sys
+import time
+import argparse
+from benchmarks.tokens import setup_environment
+from benchmarks.common import summarize, add_baseline_args, report
+
+
+def measure(fn, iterations, warmup=10):
+    for i in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        call_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def auth_benchmarks(token, iterations):
+    from auth import verify_decode_jwt, get_verified_claims
+    return {
+        'verify_decode_jwt': measure(
+            lambda: verify_decode_jwt(token), iterations),
+        'get_verified_claims (cached)': measure(
+            lambda: get_verified_claims(token), iterations)
+    }
+
+
+def format_benchmarks(iterations, rows):
+    from models import Actor
+    from listing import format_data
+    actors = [Actor('Actor %d' % i, 20 + i % 60, 'Female')
+              for i in range(rows)]
+    for i, actor in enumerate(actors):
+        actor.id = i + 1
+    return {
+        'format_data %d actors' % rows: measure(
+            lambda: format_data(actors), iterations)
+    }
+
+
+def route_benchmarks(client, headers, iterations):
+    from models import Actor, Movie
+    actor_id = Actor.query.order_by(Actor.id).first().id
+    movie_id = Movie.query.order_by(Movie.id).first().id
+
+    def get(url):
+        def request():
+            res = client.get(url, headers=headers)
+            assert res.status_code == 200, (url, res.status_code)
+        return request
+
+    routes = [
+        'GET /actors',
+        'GET /movies',
+        'GET /actors?limit=1000',
+        'GET /actors?fields=name',
+        'GET /actors?age__gte=30&limit=50',
+        'GET /movies?include=cast',
+        'GET /actors/%d/movies' % actor_id,
+        'GET /movies/%d/cast' % movie_id
+    ]
+    results = {name: measure(get(name.split(' ', 1)[1]), iterations)
+               for name in routes}
+    # A sync with nothing new since the last one
+    since = client.get('/actors?since=0&limit=1', headers=headers) \
+        .get_json()['since'].split('-')[0]
+    results['GET /actors?since=<latest>'] = measure(
+        get('/actors?since=' + since), iterations)
+
+    # The write routes clean up after themselves: the actors created by
+    # POST are then updated and deleted
+    created = []
+
+    def post():
+        res = client.post('/actors', headers=headers, json={
+            'name': 'Benchmark', 'age': 40, 'gender': 'Other'})
+        created.append(res.get_json()['id'])
+
+    def patch(ids):
+        return lambda: client.patch(
+            '/actors/%d' % next(ids), headers=headers, json={'age': 41})
+
+    def delete(ids):
+        return lambda: client.delete('/actors/%d' % next(ids),
+                                     headers=headers)
+
+    results['POST /actors'] = measure(post, iterations)
+    results['PATCH /actors/<id>'] = measure(
+        patch(iter(created)), iterations, warmup=0)
+    results['DELETE /actors/<id>'] = measure(
+        delete(iter(created)), len(created), warmup=0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--rows', type=int, default=100,
+                        help='rows serialized by the format_data benchmark')
+    parser.add_argument('--only', choices=['auth', 'format', 'routes'],
+                        nargs='+', default=['auth', 'format', 'routes'])
+    add_baseline_args(parser)
+    args = parser.parse_args()
+
+    setup_environment()
+    from app import create_app
+    from models import Actor
+    from benchmarks.seed import seed
+
+    app = create_app({'DB_CREATE_ALL': True})
+    token = os.environ['EXECUTIVE_PRODUCER']
+    if Actor.query.first() is None:
+        seed(1000, 1000, cast=3)
+
+    results = {}
+    if 'auth' in args.only:
+        results.update(auth_benchmarks(token, args.iterations))
+    if 'format' in args.only:
+        results.update(format_benchmarks(args.iterations, args.rows))
+    if 'routes' in args.only:
+        results.update(route_benchmarks(
+            app.test_client(), {'Authorization': 'Bearer ' + token},
+            args.iterations))
+    return report(args, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Fill DATABASE_URL with a reproducible dataset of actors and movies.
+
+    $ python -m benchmarks.seed --actors 100000 --movies 100000 --cast 5
+"""
+import time
+import random
+import argparse
+import datetime
+from flask import Flask
+from models import (setup_db, db, Actor, Movie, movie_cast, insert_rows,
+                    bump_version)
+
+FIRST_NAMES = [
+    'Ada', 'Ben', 'Chloe', 'David', 'Elena', 'Farid', 'Grace', 'Hiro',
+    'Ines', 'Jonas', 'Kemi', 'Liam', 'Maya', 'Noah', 'Olga', 'Pablo',
+    'Quinn', 'Rosa', 'Sami', 'Tara', 'Umar', 'Vera', 'Wei', 'Yara', 'Zoe']
+LAST_NAMES = [
+    'Adams', 'Bauer', 'Costa', 'Dubois', 'Eriksen', 'Fischer', 'Garcia',
+    'Hughes', 'Ivanova', 'Jensen', 'Kim', 'Lopez', 'Moreau', 'Nakamura',
+    'Okafor', 'Patel', 'Rossi', 'Silva', 'Tanaka', 'Weber']
+WORDS = [
+    'Midnight', 'River', 'Silent', 'Empire', 'Last', 'Golden', 'Storm',
+    'Winter', 'Shadow', 'Garden', 'Broken', 'City', 'Ocean', 'Fire',
+    'Dream', 'Road', 'Glass', 'Summer', 'Night', 'Stone']
+GENDERS = ['Female', 'Male', 'Other']
+FIRST_RELEASE = datetime.date(1950, 1, 1)
+
+
+def actor_rows(rng, count):
+    for i in range(count):
+        yield {
+            'name': '%s %s' % (rng.choice(FIRST_NAMES),
+                               rng.choice(LAST_NAMES)),
+            'age': rng.randint(18, 90),
+            'gender': rng.choice(GENDERS)
+        }
+
+
+def movie_rows(rng, count):
+    for i in range(count):
+        yield {
+            'title': '%s %s %d' % (rng.choice(WORDS), rng.choice(WORDS), i),
+            'release_date': FIRST_RELEASE + datetime.timedelta(
+                days=rng.randint(0, 365 * 75))
+        }
+
+
+def insert_in_batches(model, rows, batch_size):
+    ids = []
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            ids.extend(insert_rows(model, batch))
+            batch = []
+    ids.extend(insert_rows(model, batch))
+    return ids
+
+
+def insert_cast(rng, movie_ids, actor_ids, per_movie, batch_size):
+    per_movie = min(per_movie, len(actor_ids))
+    if not per_movie:
+        return 0
+    count = 0
+    batch = []
+    for movie_id in movie_ids:
+        batch.extend({'movie_id': movie_id, 'actor_id': actor_id}
+                     for actor_id in rng.sample(actor_ids, per_movie))
+        if len(batch) >= batch_size:
+            db.session.execute(movie_cast.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(movie_cast.insert(), batch)
+        count += len(batch)
+    bump_version(Movie.__tablename__)
+    bump_version(Actor.__tablename__)
+    db.session.commit()
+    return count
+
+
+def reset():
+    db.session.execute(movie_cast.delete())
+    db.session.execute(Movie.__table__.delete())
+    db.session.execute(Actor.__table__.delete())
+    bump_version(Movie.__tablename__)
+    bump_version(Actor.__tablename__)
+    db.session.commit()
+
+
+def seed(actors, movies, cast=0, seed=0, batch_size=10000):
+    """Insert ``actors`` actors and ``movies`` movies with ``cast`` actors
+    each. The same ``seed`` always produces the same rows."""
+    rng = random.Random(seed)
+    actor_ids = insert_in_batches(
+        Actor, actor_rows(rng, actors), batch_size)
+    movie_ids = insert_in_batches(
+        Movie, movie_rows(rng, movies), batch_size)
+    cast_count = insert_cast(rng, movie_ids, actor_ids, cast, batch_size)
+    return len(actor_ids), len(movie_ids), cast_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--cast', type=int, default=0,
+                        help='actors assigned to each movie')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch', type=int, default=10000,
+                        help='rows inserted per transaction')
+    parser.add_argument('--reset', action='store_true',
+                        help='delete the existing rows first')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, create_all=True)
+    if args.reset:
+        reset()
+    start = time.perf_counter()
+    counts = seed(args.actors, args.movies, args.cast, args.seed, args.batch)
+    print('inserted %d actors, %d movies and %d cast rows in %.1fs' % (
+        counts + (time.perf_counter() - start,)))
+
+
+if __name__ == '__main__':
+    main()
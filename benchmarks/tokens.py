@@ -0,0 +1,98 @@
+"""Mint bearer tokens with a local RSA key instead of Auth0.
+
+Writes a JWKS file that auth.py loads through JWKS_URL, and prints the
+environment the app and test_app.py need, with one token per role:
+
+    $ eval "$(python -m benchmarks.tokens)"
+"""
+import os
+import json
+import time
+import base64
+import argparse
+import tempfile
+import rsa
+from jose import jwt
+
+AUTH0_DOMAIN = 'dev-9dxdz39b.auth0.com'
+API_AUDIENCE = 'fsnd-capstone'
+KID = 'benchmark'
+
+ROLES = {
+    'CASTING_ASSISTANT': ['read:information'],
+    'CASTING_DIRECTOR': [
+        'create:actor', 'delete:actor', 'read:information',
+        'update:actor', 'update:movie'],
+    'EXECUTIVE_PRODUCER': [
+        'create:actor', 'create:movie', 'delete:actor', 'delete:movie',
+        'read:information', 'update:actor', 'update:movie']
+}
+
+
+def b64_int(n):
+    data = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalIssuer:
+    """An RSA key pair standing in for the Auth0 tenant."""
+
+    def __init__(self, bits=2048):
+        public, private = rsa.newkeys(bits)
+        self.private_pem = private.save_pkcs1().decode()
+        self.jwks = {'keys': [{
+            'kty': 'RSA', 'kid': KID, 'use': 'sig', 'alg': 'RS256',
+            'n': b64_int(public.n), 'e': b64_int(public.e)
+        }]}
+
+    def write_jwks(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.jwks, f)
+        return path
+
+    def token(self, permissions, sub='auth0|benchmark', ttl=86400):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': 'https://' + AUTH0_DOMAIN + '/',
+            'aud': API_AUDIENCE,
+            'sub': sub,
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': permissions
+        }, self.private_pem, algorithm='RS256', headers={'kid': KID})
+
+    def environment(self, jwks_path, ttl=86400):
+        env = {'JWKS_URL': jwks_path}
+        for role, permissions in ROLES.items():
+            env[role] = self.token(permissions, ttl=ttl)
+        return env
+
+
+def setup_environment(directory=None):
+    """Point auth.py at a fresh local issuer and export a token per role.
+    Must run before auth is imported."""
+    directory = directory or tempfile.mkdtemp(prefix='benchmark-')
+    issuer = LocalIssuer()
+    env = issuer.environment(
+        issuer.write_jwks(os.path.join(directory, 'jwks.json')))
+    os.environ.update(env)
+    return issuer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dir', default=tempfile.gettempdir(),
+                        help='where jwks.json is written')
+    parser.add_argument('--ttl', type=int, default=86400,
+                        help='token lifetime in seconds')
+    args = parser.parse_args()
+
+    issuer = LocalIssuer()
+    jwks_path = issuer.write_jwks(
+        os.path.abspath(os.path.join(args.dir, 'jwks.json')))
+    for name, value in issuer.environment(jwks_path, args.ttl).items():
+        print('export %s=%s' % (name, value))
+
+
+if __name__ == '__main__':
+    main()
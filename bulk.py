@@ -0,0 +1,88 @@
+import os
+from flask import request, abort, json
+from fastjson import jsonify
+from models import id_in
+from filters import build_filter
+
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 100000))
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonlines')
+
+# Bulk request helpers
+
+
+def get_bulk_items():
+    if request.mimetype in NDJSON_MIMETYPES:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(ValueError('invalid JSON'))
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(400)
+    if len(items) > BULK_MAX_ROWS:
+        abort(413)
+    return items
+
+
+def get_bulk_rows(model):
+    """Parse a JSON array or NDJSON body of ``model`` rows. Returns the
+    number of rows received, the (index, values) pairs that passed
+    validation and the errors of the others."""
+    items = get_bulk_items()
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            if isinstance(item, ValueError):
+                raise item
+            rows.append((index, model.validate(item)))
+        except ValueError as e:
+            errors.append({'index': index, 'description': str(e)})
+    return len(items), rows, errors
+
+
+def bulk_created(count, rows, ids, errors):
+    # ids are aligned with the request body, null for rejected rows
+    created = [None] * count
+    for (index, values), id in zip(rows, ids):
+        created[index] = id
+    return jsonify({
+        'ids': created,
+        'errors': errors,
+        'success': not errors
+    })
+
+
+def get_bulk_criteria(model, body):
+    """Criteria selecting the rows named by the ``ids`` list and/or the
+    ``filter`` expression of a bulk request body."""
+    criteria = []
+    ids = body.get('ids')
+    if ids is not None:
+        if (not isinstance(ids, list) or not ids or
+                len(ids) > BULK_MAX_ROWS or
+                any(isinstance(id, bool) or not isinstance(id, int)
+                    for id in ids)):
+            abort(400)
+        criteria.append(id_in(model.__table__, ids))
+    if body.get('filter') is not None:
+        try:
+            criteria.extend(build_filter(model, body['filter']))
+        except ValueError:
+            abort(400)
+    # Refuse to touch the whole table by accident
+    if not criteria:
+        abort(400)
+    return criteria
+
+
+def get_bulk_body():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    return body
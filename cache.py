@@ -0,0 +1,242 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
+from metrics import Counter, Gauge
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 32 << 20))
+RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR')
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES', 4096))
+
+# Response cache
+# The namespace of an entry is the tuple of collections it is built from,
+# and its key holds their versions. A write to a collection drops every
+# entry whose namespace includes it, whichever collection was requested.
+
+cache_hits = Counter(
+    'response_cache_hits_total', 'Response cache hits', ['tier'])
+cache_misses = Counter(
+    'response_cache_misses_total', 'Response cache misses')
+cache_bytes = Gauge(
+    'response_cache_bytes', 'Bytes held by the response cache', ['tier'])
+cache_hit_ratio = Gauge(
+    'response_cache_hit_ratio', 'Share of response cache lookups that hit')
+
+
+class LRUCache:
+    """In-process tier, bounded by the total size of the values. The keys
+    are indexed by collection, so invalidating one only visits its
+    entries."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._by_name = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self._lock:
+            value = self._entries.get((namespace, key))
+            if value is not None:
+                self._entries.move_to_end((namespace, key))
+            return value
+
+    def set(self, namespace, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._pop((namespace, key))
+            self._entries[(namespace, key)] = value
+            self.bytes += len(value)
+            for name in namespace:
+                self._by_name[name].add((namespace, key))
+            while self.bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, entry):
+        value = self._entries.pop(entry, None)
+        if value is None:
+            return
+        self.bytes -= len(value)
+        for name in entry[0]:
+            entries = self._by_name.get(name)
+            if entries is not None:
+                entries.discard(entry)
+                if not entries:
+                    del self._by_name[name]
+
+    def invalidate(self, name):
+        with self._lock:
+            for entry in list(self._by_name.get(name, ())):
+                self._pop(entry)
+
+
+class FileCacheBackend:
+    """Shared tier for the workers of one host. Point ``directory`` at a
+    tmpfs such as /dev/shm to keep it in shared memory.
+
+    Each collection has a generation number, part of the file name of the
+    entries built from it. Invalidating a collection bumps its generation,
+    and the files of older generations are removed as the directory is
+    trimmed."""
+
+    def __init__(self, directory, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=RESPONSE_CACHE_ENTRIES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def _generation_path(self, name):
+        return os.path.join(self.directory, '.generations', name)
+
+    def generation(self, name):
+        try:
+            with open(self._generation_path(name)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _path(self, namespace, key):
+        prefix = '-'.join(str(self.generation(name)) for name in namespace)
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, '.'.join(namespace),
+                            prefix + '-' + digest)
+
+    def get(self, namespace, key):
+        path = self._path(namespace, key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, namespace, key, value):
+        path = self._path(namespace, key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._trim(directory, os.path.basename(path).rsplit('-', 1)[0] + '-')
+
+    def _trim(self, directory, prefix):
+        # Files not named with the current generations can no longer be hit
+        try:
+            entries = []
+            for entry in os.scandir(directory):
+                if entry.name.startswith(prefix):
+                    entries.append(entry)
+                elif not entry.name.startswith('.'):
+                    os.remove(entry.path)
+            if len(entries) <= self.max_entries:
+                return
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_entries]:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+    def invalidate(self, name):
+        """Bump the generation of collection ``name``. Two workers bumping
+        at once may write the same number, which still differs from the
+        one the entries were stored under."""
+        directory = os.path.dirname(self._generation_path(name))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.')
+            with os.fdopen(fd, 'w') as f:
+                f.write(str(self.generation(name) + 1))
+            os.replace(tmp, self._generation_path(name))
+        except OSError:
+            pass
+
+    def size(self):
+        total = 0
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=RESPONSE_CACHE_SIZE, backend=None):
+        self.local = LRUCache(max_bytes) if max_bytes > 0 else None
+        self.backend = backend
+
+    @property
+    def enabled(self):
+        return self.local is not None or self.backend is not None
+
+    def get(self, namespace, key):
+        if self.local is not None:
+            value = self.local.get(namespace, key)
+            if value is not None:
+                cache_hits.inc(tier='local')
+                return value
+        if self.backend is not None:
+            value = self.backend.get(namespace, key)
+            if value is not None:
+                cache_hits.inc(tier='shared')
+                if self.local is not None:
+                    self.local.set(namespace, key, value)
+                return value
+        cache_misses.inc()
+        return None
+
+    def set(self, namespace, key, value):
+        if self.local is not None:
+            self.local.set(namespace, key, value)
+        if self.backend is not None:
+            self.backend.set(namespace, key, value)
+
+    def invalidate(self, name):
+        """Drop the entries built from collection ``name``."""
+        if self.local is not None:
+            self.local.invalidate(name)
+        if self.backend is not None:
+            self.backend.invalidate(name)
+
+    def hit_ratio(self):
+        hits = cache_hits.get(tier='local') + cache_hits.get(tier='shared')
+        lookups = hits + cache_misses.get()
+        return hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'hits': cache_hits.get(tier='local') +
+            cache_hits.get(tier='shared'),
+            'misses': cache_misses.get(),
+            'hit_ratio': self.hit_ratio(),
+            'local_bytes': self.local.bytes if self.local else 0,
+            'shared_bytes': self.backend.size() if self.backend else 0
+        }
+
+
+response_cache = ResponseCache(
+    backend=FileCacheBackend(RESPONSE_CACHE_DIR) if RESPONSE_CACHE_DIR
+    else None)
+
+
+def cache_sizes():
+    stats = response_cache.stats()
+    return {('local',): stats['local_bytes'],
+            ('shared',): stats['shared_bytes']}
+
+
+cache_bytes.set_function(cache_sizes)
+cache_hit_ratio.set_function(lambda: {(): response_cache.hit_ratio()})
@@ -0,0 +1,316 @@
+import os
+import json
+import time
+import uuid
+import queue
+import select
+import threading
+from collections import deque
+from flask import Response, abort, current_app, has_app_context, request
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from metrics import Counter, Gauge
+
+CHANGES_BROKER = os.environ.get('CHANGES_BROKER', 'none')
+CHANGES_CHANNEL = os.environ.get('CHANGES_CHANNEL', 'casting_agency_changes')
+CHANGES_BUFFER_SIZE = int(os.environ.get('CHANGES_BUFFER_SIZE', 1000))
+CHANGES_QUEUE_SIZE = int(os.environ.get('CHANGES_QUEUE_SIZE', 1000))
+CHANGES_MAX_IDS = int(os.environ.get('CHANGES_MAX_IDS', 500))
+CHANGES_KEEPALIVE = float(os.environ.get('CHANGES_KEEPALIVE', 15))
+CHANGES_STREAM_SECONDS = float(os.environ.get('CHANGES_STREAM_SECONDS', 300))
+# NOTIFY payloads must be shorter than 8000 bytes
+NOTIFY_MAX_BYTES = 7900
+
+# Change feed
+# The write functions of models.py queue an event per changed collection
+# on the session. Once the transaction commits, the broker hands the events
+# to every subscriber of every worker, in commit order. Each worker keeps
+# the last CHANGES_BUFFER_SIZE events so a client can resume from the id of
+# the last event it saw. Older ids get a reset event instead, the client
+# then reloads the collections. A client more than CHANGES_QUEUE_SIZE events
+# behind is dropped, its stream ends and it resumes from its last event.
+
+events_total = Counter(
+    'change_events_total', 'Change events published', ['table', 'op'])
+subscribers_gauge = Gauge(
+    'change_subscribers', 'Clients connected to GET /changes')
+subscribers_dropped = Counter(
+    'change_subscribers_dropped_total',
+    'Clients dropped for falling CHANGES_QUEUE_SIZE events behind')
+listener_reconnects = Counter(
+    'change_listener_reconnects_total',
+    'Times the LISTEN connection was lost and opened again')
+
+
+def queue_change(session, table, op, ids):
+    """Queue an ``op`` (insert, update or delete) of rows ``ids`` of
+    ``table``, published if the session commits. Large changes are sent
+    without ids."""
+    ids = list(ids)
+    session.info.setdefault('changes', []).append({
+        'table': table,
+        'op': op,
+        'ids': ids if len(ids) <= CHANGES_MAX_IDS else None
+    })
+
+
+def get_broker():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('changes')
+
+
+@event.listens_for(Session, 'before_commit')
+def notify_changes(session):
+    changes = session.info.get('changes')
+    broker = get_broker()
+    if changes and broker is not None:
+        broker.before_commit(session, changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_changes(session):
+    changes = session.info.pop('changes', None)
+    broker = get_broker()
+    if changes and broker is not None:
+        broker.after_commit(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('changes', None)
+
+
+class Subscription:
+    def __init__(self, broker, backlog, maxsize=CHANGES_QUEUE_SIZE):
+        self.broker = broker
+        self.queue = queue.Queue(max(maxsize, len(backlog)))
+        self.dropped = False
+        for item in backlog:
+            self.queue.put(item)
+
+    def put(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.dropped = True
+            self.close()
+            subscribers_dropped.inc()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Delivers the events of this process to its own subscribers. Enough
+    for a single worker, or for tests."""
+
+    def __init__(self, buffer_size=CHANGES_BUFFER_SIZE,
+                 queue_size=CHANGES_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._buffer = deque(maxlen=buffer_size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def before_commit(self, session, changes):
+        pass
+
+    def after_commit(self, changes):
+        for change in changes:
+            self.deliver(dict(change, id=uuid.uuid4().hex))
+
+    def deliver(self, change):
+        events_total.inc(table=change['table'], op=change['op'])
+        with self._lock:
+            self._buffer.append(change)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(change)
+
+    def reset(self):
+        """Tell the subscribers events may have been missed."""
+        with self._lock:
+            self._buffer.clear()
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(None)
+
+    def subscribe(self, last_event_id=None):
+        """Subscribe to the events after ``last_event_id``. A None in the
+        backlog means that id is no longer buffered."""
+        with self._lock:
+            backlog = []
+            if last_event_id:
+                ids = [change['id'] for change in self._buffer]
+                if last_event_id in ids:
+                    backlog = list(self._buffer)[ids.index(last_event_id) + 1:]
+                else:
+                    backlog = [None]
+            subscription = Subscription(self, backlog, self.queue_size)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+class PostgresBroker(LocalBroker):
+    """Sends the events with NOTIFY in the writing transaction, so they are
+    only delivered if it commits. Each worker LISTENs on one connection of
+    its own, opened by the first subscriber."""
+
+    def __init__(self, app, channel=CHANGES_CHANNEL,
+                 buffer_size=CHANGES_BUFFER_SIZE,
+                 queue_size=CHANGES_QUEUE_SIZE):
+        super().__init__(buffer_size, queue_size)
+        self.app = app
+        self.channel = channel
+        self._listener = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def before_commit(self, session, changes):
+        # One NOTIFY per transaction, whatever the number of changes
+        session.execute(
+            text('SELECT pg_notify(:channel, :payload)'),
+            {'channel': self.channel, 'payload': self.payload(changes)})
+
+    @staticmethod
+    def payload(changes):
+        """JSON list of the events of ``changes``. The ids are left out if
+        it would not fit in a NOTIFY."""
+        events = [dict(change, id=uuid.uuid4().hex) for change in changes]
+        payload = json.dumps(events)
+        if len(payload.encode()) > NOTIFY_MAX_BYTES:
+            payload = json.dumps([dict(event, ids=None) for event in events])
+        return payload
+
+    def after_commit(self, changes):
+        # Delivered by the listener, to this process too
+        pass
+
+    def subscribe(self, last_event_id=None):
+        self._ensure_listener()
+        return super().subscribe(last_event_id)
+
+    def _ensure_listener(self):
+        # Threads do not survive fork, so a forked worker starts its own
+        pid = os.getpid()
+        if self._listener_pid == pid and self._listener.is_alive():
+            return
+        with self._listener_lock:
+            if self._listener_pid == pid and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(
+                target=self._listen, name='change-listener', daemon=True)
+            self._listener_pid = pid
+            self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                self._listen_once()
+            except Exception:
+                self.app.logger.exception('change listener failed')
+            # Notifications sent while reconnecting are lost
+            listener_reconnects.inc()
+            self.reset()
+            time.sleep(1)
+
+    def _listen_once(self):
+        with self.app.app_context():
+            engine = self.app.extensions['sqlalchemy'].db.engine
+            connection = engine.raw_connection()
+        # The connection stays out of the pool for good
+        connection.detach()
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN "%s"' % self.channel)
+            while True:
+                if select.select([dbapi_connection], [], [], 60) == \
+                        ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    for change in json.loads(notify.payload):
+                        self.deliver(change)
+        finally:
+            dbapi_connection.close()
+
+
+def init_changes(app):
+    broker = app.config.get('CHANGES_BROKER', CHANGES_BROKER)
+    if broker == 'auto':
+        broker = 'postgres' if app.config['SQLALCHEMY_DATABASE_URI'] \
+            .startswith('postgres') else 'local'
+    if broker == 'postgres':
+        app.extensions['changes'] = PostgresBroker(app)
+    elif broker == 'local':
+        app.extensions['changes'] = LocalBroker()
+    elif broker != 'none':
+        raise ValueError('CHANGES_BROKER must be auto, local, postgres or '
+                         'none')
+    if 'changes' in app.extensions:
+        subscribers_gauge.set_function(
+            lambda: {(): app.extensions['changes'].subscriber_count()})
+
+
+def format_event(change):
+    if change is None:
+        return 'event: reset\ndata: {}\n\n'
+    return 'id: %s\nevent: change\ndata: %s\n\n' % (
+        change['id'], json.dumps({key: change[key] for key in
+                                  ('table', 'op', 'ids')}))
+
+
+def stream_changes(last_event_id=None, keepalive=CHANGES_KEEPALIVE,
+                   duration=CHANGES_STREAM_SECONDS):
+    """Server-sent events response of the changes after
+    ``last_event_id``. The stream ends after ``duration`` seconds, the
+    client then reconnects with the Last-Event-ID it saw. Refused with
+    a 503 by a worker that serves one request at a time, which a stream
+    would hold for its whole duration."""
+    broker = get_broker()
+    if broker is None:
+        abort(404)
+    # Set by the gthread and gevent workers of gunicorn, and by the
+    # threaded development server, not by the sync worker
+    if not request.environ.get('wsgi.multithread'):
+        abort(503)
+
+    def generate():
+        # Subscribed once the body is sent, so a response that never is
+        # leaves no subscription behind
+        subscription = broker.subscribe(last_event_id)
+        deadline = time.monotonic() + duration
+        try:
+            yield 'retry: 1000\n\n'
+            while True:
+                timeout = min(keepalive, deadline - time.monotonic())
+                if timeout <= 0:
+                    return
+                # Dropped for falling behind, the client resumes from the
+                # last event it got
+                if subscription.dropped and subscription.queue.empty():
+                    return
+                try:
+                    change = subscription.queue.get(timeout=timeout)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_event(change)
+        finally:
+            subscription.close()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stops proxies such as nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
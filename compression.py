@@ -0,0 +1,128 @@
+import os
+import zlib
+from flask import request
+from metrics import Counter
+from timing import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+COMPRESS_MIMETYPES = ('application/json', 'text/plain')
+
+# Response compression
+# Negotiated through Accept-Encoding. Brotli is preferred when the client
+# accepts it and the brotli package is installed. Event streams are never
+# compressed, the client must see every event as soon as it is sent.
+
+compressed_bytes = Counter(
+    'response_compression_bytes_total',
+    'Response bytes before (in) and after (out) compression',
+    ['encoding', 'stage'])
+
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level=None):
+        # wbits 31 writes the gzip header and trailer
+        self._compressor = zlib.compressobj(
+            COMPRESS_GZIP_LEVEL if level is None else level,
+            zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self, level=None):
+        self._compressor = brotli.Compressor(
+            quality=COMPRESS_BROTLI_QUALITY if level is None else level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+ENCODERS = {'gzip': GzipEncoder}
+if brotli is not None:
+    ENCODERS['br'] = BrotliEncoder
+
+
+def compress(data, encoding, level=None):
+    encoder = ENCODERS[encoding](level)
+    return encoder.compress(data) + encoder.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """Compress a streamed body chunk by chunk. Every chunk is flushed, so
+    the client can decode it as soon as it arrives."""
+    encoder = ENCODERS[encoding]()
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if not chunk:
+                continue
+            data = encoder.compress(chunk) + encoder.flush()
+            compressed_bytes.inc(len(chunk), encoding=encoding, stage='in')
+            compressed_bytes.inc(len(data), encoding=encoding, stage='out')
+            yield data
+        data = encoder.finish()
+        compressed_bytes.inc(len(data), encoding=encoding, stage='out')
+        yield data
+    finally:
+        # Ends the wrapped generator's request context if the client
+        # went away mid-stream
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def init_compression(app):
+    # Preference order when the client accepts several with the same q
+    preferred = [name for name in ('br', 'gzip') if name in ENCODERS]
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESS_MIMETYPES or \
+                response.status_code < 200 or \
+                response.status_code in (204, 304) or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(preferred)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_chunks(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < COMPRESS_MIN_SIZE:
+                return response
+            with timed('compress'):
+                body = compress(data, encoding)
+            compressed_bytes.inc(len(data), encoding=encoding, stage='in')
+            compressed_bytes.inc(len(body), encoding=encoding, stage='out')
+            response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        return response
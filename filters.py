@@ -0,0 +1,101 @@
+from flask import request, abort
+from models import int_value, text_value
+
+# Query parameters that are not filters
+RESERVED_ARGS = ('limit', 'after', 'fields', 'include', 'stream', 'since')
+
+# Filter expressions
+# A filter maps a field to a value, or to an object of operator and value
+# pairs, e.g. {"age": {"gte": 20, "lt": 30}, "gender": "Female"}
+
+
+def escape_like(value):
+    return (value.replace('\\', '\\\\').replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'in': lambda column, values: column.in_(values),
+    'prefix': lambda column, value: column.like(
+        escape_like(value) + '%', escape='\\'),
+    'contains': lambda column, value: column.ilike(
+        '%' + escape_like(value) + '%', escape='\\')
+}
+TEXT_OPERATORS = ('prefix', 'contains')
+
+
+def build_filter(model, spec):
+    """Translate a filter expression into a list of SQL criteria on
+    ``model``. Raises ValueError if the expression is invalid."""
+    if not isinstance(spec, dict) or not spec:
+        raise ValueError('expected a non-empty filter object')
+    validators = dict(model.validators, id=int_value)
+    criteria = []
+    for name, condition in spec.items():
+        if name not in validators:
+            raise ValueError('unknown field: ' + name)
+        validator = validators[name]
+        if not isinstance(condition, dict):
+            condition = {'eq': condition}
+        if not condition:
+            raise ValueError('%s: expected an operator' % name)
+        for op, value in condition.items():
+            if op not in OPERATORS:
+                raise ValueError('%s: unknown operator %s' % (name, op))
+            try:
+                if op == 'in':
+                    if not isinstance(value, list) or not value:
+                        raise ValueError('expected a non-empty list')
+                    value = [validator(v) for v in value]
+                elif op in TEXT_OPERATORS:
+                    if validator is not text_value:
+                        raise ValueError('%s only applies to text' % op)
+                    value = text_value(value)
+                else:
+                    value = validator(value)
+            except ValueError as e:
+                raise ValueError('%s: %s' % (name, e))
+            criteria.append(OPERATORS[op](getattr(model, name), value))
+    return criteria
+
+
+def query_value(validator, value):
+    # Query parameters are strings, convert them before validating
+    if validator is int_value:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError('expected a non-negative integer')
+    return value
+
+
+def get_filter_args(model):
+    """Build criteria from the query string, e.g. ``?age__gte=20`` or
+    ``?name__prefix=Al``. A bare field name means equality and ``in``
+    takes a comma separated list."""
+    validators = dict(model.validators, id=int_value)
+    spec = {}
+    try:
+        for key, value in request.args.items(multi=True):
+            if key in RESERVED_ARGS:
+                continue
+            name, _, op = key.partition('__')
+            if name not in validators:
+                raise ValueError('unknown field: ' + name)
+            validator = validators[name]
+            if op == 'in':
+                value = [query_value(validator, v) for v in value.split(',')]
+            elif op not in TEXT_OPERATORS:
+                value = query_value(validator, value)
+            spec.setdefault(name, {})[op or 'eq'] = value
+        if not spec:
+            return []
+        return build_filter(model, spec)
+    except ValueError:
+        abort(400)
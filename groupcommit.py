@@ -0,0 +1,176 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from flask import current_app
+from models import (db, add_rows, change_rows, insert_rows, update_rows,
+                    bump_versions, has_rows)
+from metrics import Counter, Histogram
+from pool import env_flag
+
+GROUP_COMMIT = env_flag('GROUP_COMMIT', False)
+GROUP_COMMIT_INTERVAL_MS = float(os.environ.get('GROUP_COMMIT_INTERVAL_MS', 5))
+GROUP_COMMIT_MAX_ROWS = int(os.environ.get('GROUP_COMMIT_MAX_ROWS', 100))
+GROUP_COMMIT_TIMEOUT = float(os.environ.get('GROUP_COMMIT_TIMEOUT', 10))
+
+# Group commit
+# Single-row writes of concurrent requests in a worker are queued and
+# committed together by one thread, so they share a transaction and its
+# fsync. Each request still waits for its own id or error, up to
+# GROUP_COMMIT_TIMEOUT seconds.
+
+batch_size = Histogram(
+    'group_commit_batch_size', 'Writes committed per group commit',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+batch_failures = Counter(
+    'group_commit_failures_total',
+    'Group commits that failed and were replayed one write at a time')
+
+
+class GroupCommitTimeout(Exception):
+    pass
+
+
+class GroupCommitter:
+    """Commits the queued writes every ``interval`` seconds, or as soon as
+    ``max_rows`` are waiting."""
+
+    def __init__(self, app, interval=GROUP_COMMIT_INTERVAL_MS / 1000,
+                 max_rows=GROUP_COMMIT_MAX_ROWS,
+                 timeout=GROUP_COMMIT_TIMEOUT):
+        self.app = app
+        self.interval = interval
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+
+    def insert(self, model, values):
+        return self._submit('insert', model, values)
+
+    def update(self, model, values, criteria):
+        return self._submit('update', model, values, criteria)
+
+    def _submit(self, op, model, *args):
+        future = Future()
+        self._ensure_flusher()
+        self._queue.put((future, op, model, args))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # The write may still commit later
+            raise GroupCommitTimeout()
+
+    def _ensure_flusher(self):
+        # Threads do not survive fork, so a forked worker starts its own
+        pid = os.getpid()
+        if self._flusher_pid == pid and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher_pid == pid and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(
+                target=self._run, name='group-commit', daemon=True)
+            self._flusher_pid = pid
+            self._flusher.start()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.interval
+                while len(batch) < self.max_rows:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                try:
+                    self._commit(batch)
+                except Exception as e:
+                    # Keep the flusher alive and fail the writes left waiting
+                    self.app.logger.exception('group commit failed')
+                    db.session.remove()
+                    for future, op, model, args in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def _commit(self, batch):
+        batch_size.observe(len(batch))
+        try:
+            results = self._apply(batch)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            batch_failures.inc()
+            # One bad write must not fail the others
+            for write in batch:
+                self._commit_one(*write)
+            return
+        for (future, op, model, args), result in zip(batch, results):
+            future.set_result(result)
+
+    def _apply(self, batch):
+        results = [None] * len(batch)
+        inserts = OrderedDict()
+        updates = []
+        for i, (future, op, model, args) in enumerate(batch):
+            if op == 'insert':
+                inserts.setdefault(model, []).append((i, args[0]))
+            elif has_rows(model, args[1]):
+                updates.append((i, model, args))
+            else:
+                # Leaves the version, and so the caches, alone
+                results[i] = []
+        # One bump per collection, in the same order as every other write
+        times = bump_versions(
+            [model.__tablename__ for model in inserts] +
+            [model.__tablename__ for i, model, args in updates])
+        for i, model, args in updates:
+            results[i] = change_rows(
+                model, *args, updated_at=times[model.__tablename__])
+        # The inserts of each model go in one multi-row INSERT
+        for model, rows in inserts.items():
+            ids = add_rows(model, [values for i, values in rows],
+                           updated_at=times[model.__tablename__])
+            for (i, values), id in zip(rows, ids):
+                results[i] = id
+        return results
+
+    def _commit_one(self, future, op, model, args):
+        try:
+            if op == 'insert':
+                result = insert_rows(model, [args[0]])[0]
+            else:
+                result = update_rows(model, *args)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+
+def init_group_commit(app):
+    if app.config.get('GROUP_COMMIT', GROUP_COMMIT):
+        app.extensions['group_commit'] = GroupCommitter(app)
+
+
+def insert_one(model, values):
+    """Insert one row and return its id, through the group commit when it
+    is enabled."""
+    committer = current_app.extensions.get('group_commit')
+    if committer is None:
+        return insert_rows(model, [values])[0]
+    return committer.insert(model, values)
+
+
+def update_one(model, values, criteria):
+    committer = current_app.extensions.get('group_commit')
+    if committer is None:
+        return update_rows(model, values, criteria)
+    return committer.update(model, values, criteria)
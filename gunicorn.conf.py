@@ -0,0 +1,27 @@
+# gunicorn settings, read from the working directory by default
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# Import the app once in the master, so workers fork ready to serve and
+# share its memory. The database connects lazily, but an engine that did
+# connect in the master is reset around the fork.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in (
+    '1', 'true', 'yes')
+
+
+def pre_fork(server, worker):
+    if server.cfg.preload_app:
+        from models import dispose_engines
+        from wsgi import app
+        dispose_engines(app)
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from auth import jwks_store
+        from models import dispose_engines
+        from wsgi import app
+        dispose_engines(app)
+        jwks_store.reset()
@@ -0,0 +1,323 @@
+import os
+from functools import wraps, lru_cache
+from urllib.parse import urlencode
+from flask import request, abort, Response, stream_with_context
+from datetime import datetime, timedelta
+from sqlalchemy import and_, select, tuple_
+from models import (db, column_in, get_versions, live, EPOCH_NAME,
+                    SYNC_TOMBSTONE_DAYS)
+from cache import response_cache
+from filters import get_filter_args
+from timing import timed
+from fastjson import dumps
+
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+
+# Collection listing helpers
+
+
+def format_data(d):
+    return [data.format() for data in d]
+
+
+def get_int_arg(name, default=None, minimum=0):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if value < minimum:
+        abort(400)
+    return value
+
+
+def get_page_args():
+    limit = get_int_arg('limit', PAGE_SIZE, minimum=1)
+    after = get_int_arg('after', 0)
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+def get_fields(model):
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    if not names or any(name not in model.fields for name in names):
+        abort(400)
+    # The id is the pagination cursor, so it is always returned
+    return ('id',) + tuple(name for name in names if name != 'id')
+
+
+def get_includes(model):
+    include = request.args.get('include')
+    if not include:
+        return []
+    names = [name.strip() for name in include.split(',') if name.strip()]
+    if not names or any(name not in model.includes for name in names):
+        abort(400)
+    return names
+
+
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('1', 'true')
+
+
+class Serializer:
+    """Turns the row tuples of a column-only select of ``fields`` into
+    output dicts."""
+
+    __slots__ = ('names', 'columns')
+
+    def __init__(self, model, fields=None):
+        self.names = tuple(fields or model.fields)
+        self.columns = [model.__table__.c[name] for name in self.names]
+
+    def __call__(self, rows):
+        names = self.names
+        return [dict(zip(names, row)) for row in rows]
+
+
+@lru_cache(maxsize=256)
+def get_serializer(model, fields=None):
+    return Serializer(model, fields)
+
+
+def collection_select(model, serializer, after, criteria=()):
+    table = model.__table__
+    return select(serializer.columns) \
+        .where(and_(table.c.id > after, live(table), *criteria)) \
+        .order_by(table.c.id)
+
+
+def related_rows(model, name, ids):
+    """Return the rows related to each of ``ids`` through the ``name``
+    relationship of ``model``, in one query."""
+    relationship = model.__mapper__.relationships[name]
+    target = relationship.mapper.class_
+    (_, parent_key), = relationship.synchronize_pairs
+    (target_id, target_key), = relationship.secondary_synchronize_pairs
+    serializer = get_serializer(target)
+    query = select([parent_key] + serializer.columns) \
+        .select_from(target.__table__.join(
+            relationship.secondary, target_id == target_key)) \
+        .where(and_(column_in(parent_key, ids), live(target.__table__))) \
+        .order_by(parent_key, target_id)
+
+    related = {id: [] for id in ids}
+    names = serializer.names
+    for row in db.session.execute(query):
+        related[row[0]].append(dict(zip(names, row[1:])))
+    return related
+
+
+def fetch_rows(model, fields, after, limit, includes=(), criteria=()):
+    """Read ``limit`` rows of ``model`` after the ``after`` cursor with a
+    Core select and serialize them straight from the row tuples."""
+    serializer = get_serializer(model, fields)
+    rows = db.session.execute(
+        collection_select(model, serializer, after, criteria).limit(limit)
+    ).fetchall()
+
+    with timed('serialize'):
+        data = serializer(rows)
+    if data:
+        for name in includes:
+            related = related_rows(model, name, [d['id'] for d in data])
+            for d in data:
+                d[name] = related[d['id']]
+    return data
+
+
+def fetch_page(model):
+    """Return one keyset page of ``model`` rows ordered by id, together
+    with the cursor of the next page."""
+    limit, after = get_page_args()
+    fields = get_fields(model)
+    includes = get_includes(model)
+    criteria = get_filter_args(model)
+
+    data = fetch_rows(model, fields, after, limit, includes, criteria)
+    next_cursor = data[-1]['id'] if len(data) == limit else None
+    return data, next_cursor
+
+
+# Sync tokens
+# A token is the updated_at of the last change seen, in microseconds since
+# the epoch, followed by the id of the last row seen when the changes made
+# at that time did not fit in one page.
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def sync_token(updated_at, id=None):
+    token = str((updated_at - EPOCH) // timedelta(microseconds=1))
+    return token if id is None else '%s-%d' % (token, id)
+
+
+def get_since_arg():
+    try:
+        parts = [int(part) for part in request.args['since'].split('-')]
+        if len(parts) > 2 or min(parts) < 0:
+            raise ValueError
+        updated_at = EPOCH + timedelta(microseconds=parts[0])
+    except (ValueError, OverflowError):
+        abort(400)
+    return updated_at, parts[1] if len(parts) == 2 else None
+
+
+def wants_changes():
+    return 'since' in request.args
+
+
+def fetch_changes(model):
+    """Return the ``model`` rows changed after the ``since`` token, the ids
+    of the rows deleted since, and the token of the next request. The rows
+    are read in (updated_at, id) order through the index, so the cost
+    depends on the number of changes rather than the size of the table.
+    Aborts with 410 for a token older than SYNC_TOMBSTONE_DAYS."""
+    updated_at, after = get_since_arg()
+    # Tombstones past the retention window may be purged, so the client
+    # has to start again from since=0
+    if EPOCH < updated_at < \
+            datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS):
+        abort(410)
+    limit, _ = get_page_args()
+    fields = get_fields(model)
+    includes = get_includes(model)
+    # A row changed to no longer match a filter would go unnoticed
+    if get_filter_args(model):
+        abort(400)
+
+    # Writes commit in updated_at order, so every change up to the last
+    # committed one is visible
+    until = get_versions([model.__tablename__])[0][1]
+    if until is None or until < updated_at:
+        return [], [], request.args['since'], False
+    table = model.__table__
+    serializer = get_serializer(model, fields)
+    if after is None:
+        since = table.c.updated_at > updated_at
+    else:
+        since = tuple_(table.c.updated_at, table.c.id) > \
+            tuple_(updated_at, after)
+    rows = db.session.execute(
+        select(serializer.columns + [table.c.updated_at, table.c.deleted_at])
+        .where(and_(since, table.c.updated_at <= until))
+        .order_by(table.c.updated_at, table.c.id)
+        .limit(limit)).fetchall()
+
+    with timed('serialize'):
+        data = serializer(row[:-2] for row in rows if row[-1] is None)
+    deleted = [row.id for row in rows if row[-1] is not None]
+    if data:
+        for name in includes:
+            related = related_rows(model, name, [d['id'] for d in data])
+            for d in data:
+                d[name] = related[d['id']]
+    if len(rows) == limit:
+        return data, deleted, sync_token(rows[-1][-2], rows[-1].id), True
+    return data, deleted, sync_token(until), False
+
+
+def stream_collection(model, key):
+    """Stream every ``model`` row after the ``after`` cursor as one JSON
+    document, reading the rows through a server-side cursor."""
+    after = get_int_arg('after', 0)
+    fields = get_fields(model)
+    includes = get_includes(model)
+    criteria = get_filter_args(model)
+
+    def batches():
+        if includes:
+            # The related rows are read per batch, so walk the table in
+            # keyset pages instead
+            cursor = after
+            while True:
+                batch = fetch_rows(model, fields, cursor, STREAM_BATCH_SIZE,
+                                   includes, criteria)
+                if not batch:
+                    return
+                yield batch
+                cursor = batch[-1]['id']
+        else:
+            serializer = get_serializer(model, fields)
+            result = db.session.execute(
+                collection_select(model, serializer, after, criteria)
+                .execution_options(stream_results=True))
+            while True:
+                rows = result.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    return
+                yield serializer(rows)
+
+    def generate():
+        yield '{%s:[' % dumps(key)
+        separator = ''
+        for batch in batches():
+            yield separator + ','.join(dumps(data) for data in batch)
+            separator = ','
+        yield '],"success":true}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def cache_key(etag):
+    args = urlencode(sorted(request.args.items(multi=True)))
+    return '%s %s?%s' % (etag, request.path, args)
+
+
+def conditional(model):
+    """Tag a collection response with the version of the collections it is
+    built from. Answer If-None-Match / If-Modified-Since with 304, and
+    serve repeat requests from the response cache, before querying the
+    rows."""
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            names = [model.__tablename__] + [
+                getattr(model, name).property.mapper.class_.__tablename__
+                for name in get_includes(model)]
+            *versions, (epoch, _) = get_versions(names + [EPOCH_NAME])
+            etag = '%x.' % epoch + '.'.join(
+                '%s-%d' % (name, version)
+                for name, (version, _) in zip(names, versions))
+            times = [updated_at for _, updated_at in versions if updated_at]
+            updated_at = max(times) if times else None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                # Last-Modified drops the fraction of a second, so it cannot
+                # tell this version from a later write in the same second
+                not_modified = (
+                    updated_at is not None and
+                    updated_at.microsecond == 0 and
+                    request.if_modified_since is not None and
+                    request.if_modified_since >= updated_at)
+            if not_modified:
+                response = Response(status=304)
+            elif response_cache.enabled and not wants_stream():
+                key = cache_key(etag)
+                cached = response_cache.get(tuple(names), key)
+                if cached is not None:
+                    response = Response(cached, mimetype='application/json')
+                else:
+                    response = f(*args, **kwargs)
+                    if response.status_code == 200:
+                        response_cache.set(tuple(names), key,
+                                           response.get_data())
+            else:
+                response = f(*args, **kwargs)
+            response.set_etag(etag, weak=True)
+            if updated_at is not None:
+                response.last_modified = updated_at
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return conditional_decorator
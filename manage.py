@@ -1,8 +1,9 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
-from models import db
+from wsgi import app
+from models import db, SYNC_TOMBSTONE_DAYS
+import models
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +11,20 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('--days', type=int, default=SYNC_TOMBSTONE_DAYS,
+                help='Keep the rows deleted in the last DAYS days')
+def purge_tombstones(days):
+    """Remove the tombstones of rows deleted more than DAYS ago."""
+    for name, count in models.purge_tombstones(days).items():
+        print('%s: %d purged' % (name, count))
+
+
+@manager.command
+def reset_cache_epoch():
+    """Invalidate every ETag and cached response, after restoring a
+    backup."""
+    models.reset_epoch()
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,73 @@
+"""initial schema
+
+Revision ID: 3f2a9c1d7b04
+Revises: 
+Create Date: 2026-10-18 20:40:12.518342
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b04'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created by db.create_all() already have these tables
+    existing = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'movie' not in existing:
+        op.create_table(
+            'movie',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release_date', sa.Date(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'actor' not in existing:
+        op.create_table(
+            'actor',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'movie_cast' not in existing:
+        op.create_table(
+            'movie_cast',
+            sa.Column('movie_id', sa.Integer(), nullable=False),
+            sa.Column('actor_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['actor_id'], ['actor.id'],
+                                    ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['movie_id'], ['movie.id'],
+                                    ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+        )
+        op.create_index('ix_movie_cast_actor_id', 'movie_cast',
+                        ['actor_id'], unique=False)
+    if 'collection_version' not in existing:
+        collection_version = op.create_table(
+            'collection_version',
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('name')
+        )
+        op.bulk_insert(collection_version, [
+            {'name': name, 'version': 0, 'updated_at': datetime.utcnow()}
+            for name in ('movie', 'actor')
+        ])
+
+
+def downgrade():
+    op.drop_table('collection_version')
+    op.drop_index('ix_movie_cast_actor_id', table_name='movie_cast')
+    op.drop_table('movie_cast')
+    op.drop_table('actor')
+    op.drop_table('movie')
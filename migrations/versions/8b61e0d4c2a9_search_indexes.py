@@ -0,0 +1,58 @@
+"""search indexes
+
+Revision ID: 8b61e0d4c2a9
+Revises: 3f2a9c1d7b04
+Create Date: 2026-10-18 20:41:37.904116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b61e0d4c2a9'
+down_revision = '3f2a9c1d7b04'
+branch_labels = None
+depends_on = None
+
+
+def create_index(name, table, columns, **kw):
+    # Databases created by db.create_all() may already have the index
+    inspector = sa.inspect(op.get_bind())
+    if name not in {index['name'] for index in inspector.get_indexes(table)}:
+        op.create_index(name, table, columns, unique=False, **kw)
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    # Range filters on age and release date
+    create_index('ix_actor_age', 'actor', ['age'])
+    create_index('ix_movie_release_date', 'movie', ['release_date'])
+
+    # Prefix searches (name__prefix, title__prefix). text_pattern_ops lets
+    # PostgreSQL use the index for LIKE 'x%' under any collation.
+    create_index('ix_actor_name', 'actor', ['name'],
+                 postgresql_ops={'name': 'text_pattern_ops'})
+    create_index('ix_movie_title', 'movie', ['title'],
+                 postgresql_ops={'title': 'text_pattern_ops'})
+
+    # Substring searches (name__contains, title__contains)
+    if postgresql:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        create_index('ix_actor_name_trgm', 'actor', ['name'],
+                     postgresql_using='gin',
+                     postgresql_ops={'name': 'gin_trgm_ops'})
+        create_index('ix_movie_title_trgm', 'movie', ['title'],
+                     postgresql_using='gin',
+                     postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_movie_title_trgm', table_name='movie')
+        op.drop_index('ix_actor_name_trgm', table_name='actor')
+    op.drop_index('ix_movie_title', table_name='movie')
+    op.drop_index('ix_actor_name', table_name='actor')
+    op.drop_index('ix_movie_release_date', table_name='movie')
+    op.drop_index('ix_actor_age', table_name='actor')
@@ -0,0 +1,59 @@
+"""sync columns
+
+Revision ID: c7d4e19a5f36
+Revises: 8b61e0d4c2a9
+Create Date: 2026-10-18 23:12:05.417829
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d4e19a5f36'
+down_revision = '8b61e0d4c2a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    now = datetime.utcnow()
+
+    for table in ('actor', 'movie'):
+        # Databases created by db.create_all() may already have them
+        columns = {column['name'] for column in inspector.get_columns(table)}
+        if 'updated_at' not in columns:
+            op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+                                           nullable=True))
+            # Sync reads stop at the collection's updated_at
+            updated_at = op.get_bind().execute(
+                sa.text('SELECT updated_at FROM collection_version '
+                        'WHERE name = :name'), name=table).scalar()
+            op.execute(sa.table(table, sa.column('updated_at')).update()
+                       .values(updated_at=updated_at or now))
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.alter_column('updated_at',
+                                      existing_type=sa.DateTime(),
+                                      nullable=False)
+        if 'deleted_at' not in columns:
+            op.add_column(table, sa.Column('deleted_at', sa.DateTime(),
+                                           nullable=True))
+
+        # Sync queries walk the changes in (updated_at, id) order
+        name = 'ix_%s_updated_at' % table
+        if name not in {index['name']
+                        for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, ['updated_at', 'id'], unique=False)
+
+
+def downgrade():
+    for table in ('movie', 'actor'):
+        op.drop_index('ix_%s_updated_at' % table, table_name=table)
+        # Deleted rows are tombstones until now
+        rows = sa.table(table, sa.column('deleted_at'))
+        op.execute(rows.delete().where(rows.c.deleted_at.isnot(None)))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('deleted_at')
+            batch_op.drop_column('updated_at')
@@ -0,0 +1,42 @@
+"""cache epoch
+
+Revision ID: e5a1b3c8d2f7
+Revises: c7d4e19a5f36
+Create Date: 2026-10-19 10:41:27.301854
+
+"""
+import secrets
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1b3c8d2f7'
+down_revision = 'c7d4e19a5f36'
+branch_labels = None
+depends_on = None
+
+collection_version = sa.table(
+    'collection_version',
+    sa.column('name', sa.String()),
+    sa.column('version', sa.Integer()),
+    sa.column('updated_at', sa.DateTime()))
+
+
+def upgrade():
+    # Databases created by db.create_all() already have it
+    exists = op.get_bind().execute(
+        sa.select([collection_version.c.name])
+        .where(collection_version.c.name == '_epoch')).first()
+    if exists is None:
+        op.bulk_insert(collection_version, [{
+            'name': '_epoch',
+            'version': secrets.randbits(31),
+            'updated_at': datetime.utcnow()
+        }])
+
+
+def downgrade():
+    op.execute(collection_version.delete()
+               .where(collection_version.c.name == '_epoch'))
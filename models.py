@@ -1,34 +1,554 @@
 import os
-from sqlalchemy import Column, String, create_engine, Integer, Date
-from flask_sqlalchemy import SQLAlchemy
+import io
+import secrets
+from datetime import date, datetime, timedelta
+from sqlalchemy import (
+    Column, String, create_engine, Integer, Date, DateTime, select, text,
+    and_, any_, bindparam, case, ForeignKey, Index
+)
+from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import ARRAY
+from pool import engine_options, env_flag
+from routing import RoutingSQLAlchemy, init_replicas
+from cache import response_cache
+from changes import queue_change
 import json
 
-database_path = os.environ['DATABASE_URL']
+INSERT_CHUNK_SIZE = 1000
+COPY_MIN_ROWS = int(os.environ.get('COPY_MIN_ROWS', 5000))
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', 30))
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
-def setup_db(app, database_path=database_path):
+def get_replica_paths():
+    return [url.strip() for url in
+            os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+            if url.strip()]
+
+
+def setup_db(app, database_path=None, replica_paths=None, create_all=None):
+    """Configure the database of ``app``. Nothing connects until the first
+    query. The schema is created by the migrations, unless ``create_all``
+    (or DB_CREATE_ALL) asks for it."""
+    if database_path is None:
+        database_path = app.config.get('DATABASE_URL') or \
+            os.environ['DATABASE_URL']
+    if replica_paths is None:
+        replica_paths = get_replica_paths()
+    if create_all is None:
+        create_all = app.config.get(
+            'DB_CREATE_ALL', env_flag('DB_CREATE_ALL', False))
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    init_replicas(app, replica_paths,
+                  os.environ.get('DB_REPLICA_STRATEGY', 'round_robin'))
+    if create_all:
+        # In a context of its own, so the session is removed afterwards
+        # instead of staying bound to this app
+        with app.app_context():
+            db.create_all()
+            seed_versions()
+
+
+def dispose_engines(app):
+    """Drop the pooled connections of the primary and replica engines.
+    gunicorn runs it in the master before forking and in each worker after,
+    so no connection is shared between processes."""
+    with app.app_context():
+        db.engine.dispose()
+    router = app.extensions.get('replicas')
+    if router is not None:
+        router.dispose()
+
+
+# Collection versions
+# Every write to a collection bumps its version in the same transaction, so
+# a conditional GET can be answered by reading a single row. The bump locks
+# the row until the write commits, so the writes of a collection commit in
+# the order of their updated_at.
+
+
+class CollectionVersion(db.Model):
+    __tablename__ = 'collection_version'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+# The version of this row is a random number drawn when the database is
+# created. It is part of every ETag and cache key, so a recreated database,
+# whose versions start again from 0, does not match the old responses.
+EPOCH_NAME = '_epoch'
+
+
+def new_epoch():
+    return secrets.randbits(31)
+
+
+def seed_versions():
+    table = CollectionVersion.__table__
+    existing = {row.name for row in db.session.execute(
+        select([table.c.name]))}
+    missing = [
+        {'name': name, 'version': 0, 'updated_at': datetime.utcnow()}
+        for name in (Movie.__tablename__, Actor.__tablename__)
+        if name not in existing
+    ]
+    if EPOCH_NAME not in existing:
+        missing.append({'name': EPOCH_NAME, 'version': new_epoch(),
+                        'updated_at': datetime.utcnow()})
+    if missing:
+        db.session.execute(table.insert(), missing)
+    db.session.commit()
+
+
+def reset_epoch():
+    """Draw a new epoch, to run after restoring a backup, whose versions
+    may repeat ones already served."""
+    table = CollectionVersion.__table__
+    db.session.execute(table.delete().where(table.c.name == EPOCH_NAME))
+    db.session.execute(table.insert().values(
+        name=EPOCH_NAME, version=new_epoch(), updated_at=datetime.utcnow()))
+    db.session.commit()
+
+
+def bump_version(name):
+    """Bump the version of collection ``name`` and return the time of the
+    change, later than that of every change committed before it."""
+    # Cached responses are keyed by version, so entries of the old version
+    # can no longer be hit. Drop them to free the memory.
+    response_cache.invalidate(name)
+    table = CollectionVersion.__table__
+    now = datetime.utcnow()
+    if db.engine.dialect.name == 'postgresql':
+        # A single statement, which locks the row only while it updates it.
+        # The clocks of the hosts may disagree.
+        updated_at = db.session.execute(
+            table.update()
+            .where(table.c.name == name)
+            .values(version=table.c.version + 1, updated_at=case(
+                [(table.c.updated_at < now, now)],
+                else_=table.c.updated_at + timedelta(microseconds=1)))
+            .returning(table.c.updated_at)).scalar()
+    else:
+        # SQLite has one writer at a time, the first UPDATE makes it this one
+        bumped = db.session.execute(
+            table.update()
+            .where(table.c.name == name)
+            .values(version=table.c.version + 1)).rowcount
+        updated_at = None
+        if bumped:
+            previous = db.session.execute(
+                select([table.c.updated_at])
+                .where(table.c.name == name)).scalar()
+            updated_at = max(now, previous + timedelta(microseconds=1))
+            db.session.execute(
+                table.update()
+                .where(table.c.name == name)
+                .values(updated_at=updated_at))
+    if updated_at is None:
+        db.session.execute(table.insert().values(
+            name=name, version=1, updated_at=now))
+        updated_at = now
+    return updated_at
+
+
+def bump_versions(names):
+    """Bump the versions of collections ``names`` and return the time of
+    the change of each. The rows are locked in name order, so transactions
+    bumping several collections never wait on each other in a cycle."""
+    return {name: bump_version(name) for name in sorted(set(names))}
+
+
+def record_change(name, op, ids):
+    """Queue a change event for the ``ids`` of collection ``name`` that
+    were inserted, updated or deleted."""
+    queue_change(db.session, name, op, ids)
+
+
+def get_versions(names):
+    """Return the version and last update time of each named collection,
+    in one query."""
+    table = CollectionVersion.__table__
+    rows = {row.name: row for row in db.session.execute(
+        select([table.c.name, table.c.version, table.c.updated_at])
+        .where(table.c.name.in_(names)))}
+    return [(rows[name].version, rows[name].updated_at) if name in rows
+            else (0, None) for name in names]
+
+
+def get_version(name):
+    return get_versions([name])[0]
+
+
+# Validation
+
+
+def text_value(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('expected a non-empty string')
+    return value
+
+
+def int_value(value):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError('expected a non-negative integer')
+    return value
+
+
+def date_value(value):
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError('expected a date in YYYY-MM-DD format')
+
+
+def validate_fields(data, validators, partial=False):
+    if not isinstance(data, dict):
+        raise ValueError('expected an object')
+    unknown = sorted(set(data) - set(validators))
+    if unknown:
+        raise ValueError('unknown field: ' + ', '.join(unknown))
+    values = {}
+    for name, validator in validators.items():
+        if name not in data:
+            if not partial:
+                raise ValueError('missing field: ' + name)
+            continue
+        try:
+            values[name] = validator(data[name])
+        except ValueError as e:
+            raise ValueError('%s: %s' % (name, e))
+    return values
+
+
+# Bulk writes
+
+
+def add_rows(model, rows, updated_at=None):
+    """Insert validated ``rows`` of ``model`` in the current transaction
+    and return their ids in order. ``updated_at`` is the time of a version
+    bump already made by the caller."""
+    table = model.__table__
+    if updated_at is None:
+        updated_at = bump_version(table.name)
+    rows = [dict(row, updated_at=updated_at) for row in rows]
+    if db.engine.dialect.name == 'postgresql':
+        if len(rows) >= COPY_MIN_ROWS:
+            ids = copy_rows(table, rows)
+        else:
+            ids = []
+            for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+                result = db.session.execute(
+                    table.insert()
+                    .values(rows[i:i + INSERT_CHUNK_SIZE])
+                    .returning(table.c.id))
+                ids.extend(row.id for row in result)
+    else:
+        # No multi-row RETURNING, let the ORM fetch the ids
+        db.session.bulk_insert_mappings(model, rows, return_defaults=True)
+        ids = [row['id'] for row in rows]
+    record_change(table.name, 'insert', ids)
+    return ids
+
+
+def insert_rows(model, rows):
+    """Insert validated ``rows`` of ``model`` in one transaction and return
+    their ids in order."""
+    if not rows:
+        return []
+    try:
+        ids = add_rows(model, rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, date):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_rows(table, rows):
+    # COPY cannot return the generated ids, so reserve them up front
+    connection = db.session.connection()
+    ids = [row[0] for row in connection.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+             "FROM generate_series(1, :count)"),
+        table=table.name, count=len(rows))]
+    columns = [c.name for c in table.columns]
+    buffer = io.StringIO()
+    for id, row in zip(ids, rows):
+        row = dict(row, id=id)
+        buffer.write('\t'.join(copy_value(row.get(c)) for c in columns))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (
+            table.name, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+    return ids
+
+
+def column_in(column, values, key='ids'):
+    if db.engine.dialect.name == 'postgresql':
+        # One array parameter instead of one parameter per value
+        return column == any_(
+            bindparam(key, value=list(values), type_=ARRAY(column.type)))
+    return column.in_(values)
+
+
+def id_in(table, ids):
+    return column_in(table.c.id, ids)
+
+
+def live(table):
+    """Criterion of the rows of ``table`` that are not deleted."""
+    return table.c.deleted_at.is_(None)
+
+
+def set_rows(table, values, criteria):
+    """Apply ``values`` to the live rows of ``table`` matching ``criteria``
+    with a single UPDATE and return their ids."""
+    where = and_(live(table), *criteria)
+    if db.engine.dialect.name == 'postgresql':
+        result = db.session.execute(
+            table.update().where(where).values(**values)
+            .returning(table.c.id))
+        return [row.id for row in result]
+    ids = [row.id for row in db.session.execute(
+        select([table.c.id]).where(where).with_for_update())]
+    if ids:
+        db.session.execute(
+            table.update().where(id_in(table, ids)).values(**values))
+    return ids
+
+
+def has_rows(model, criteria):
+    table = model.__table__
+    return db.session.execute(
+        select([table.c.id]).where(and_(live(table), *criteria)).limit(1)
+    ).first() is not None
+
+
+def change_rows(model, values, criteria, updated_at=None):
+    """Apply ``values`` to every ``model`` row matching ``criteria`` in the
+    current transaction and return the ids of the updated rows.
+    ``updated_at`` is the time of a version bump already made by the
+    caller."""
+    table = model.__table__
+    if updated_at is None:
+        updated_at = bump_version(table.name)
+    ids = set_rows(table, dict(values, updated_at=updated_at), criteria)
+    if ids:
+        record_change(table.name, 'update', ids)
+    return ids
+
+
+def update_rows(model, values, criteria):
+    """Apply ``values`` to every ``model`` row matching ``criteria`` with a
+    single UPDATE and return the ids of the updated rows."""
+    try:
+        ids = change_rows(model, values, criteria)
+        if ids:
+            db.session.commit()
+        else:
+            # Undo the version bump
+            db.session.rollback()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def delete_rows(model, criteria):
+    """Delete every ``model`` row matching ``criteria`` and return the ids
+    of the deleted rows. The rows are kept as tombstones, so that clients
+    syncing with ``since`` learn about the deletion."""
+    table = model.__table__
+    try:
+        deleted_at = bump_version(table.name)
+        ids = set_rows(table, {'deleted_at': deleted_at,
+                               'updated_at': deleted_at}, criteria)
+        if not ids:
+            db.session.rollback()
+            return ids
+        # What the foreign keys used to cascade
+        for column in movie_cast.c:
+            if column.references(table.c.id):
+                db.session.execute(
+                    movie_cast.delete().where(column_in(column, ids)))
+        record_change(table.name, 'delete', ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+def purge_tombstones(days=SYNC_TOMBSTONE_DAYS):
+    """Remove the rows deleted more than ``days`` ago and return how many
+    were removed per collection. Sync tokens older than that are refused,
+    so no client misses the deletions."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    purged = {}
+    for model in (Movie, Actor):
+        table = model.__table__
+        purged[table.name] = db.session.execute(
+            table.delete().where(table.c.deleted_at < cutoff)).rowcount
+    db.session.commit()
+    return purged
+
+
+# Cast assignments
+
+
+movie_cast = db.Table(
+    'movie_cast',
+    Column('movie_id', Integer,
+           ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actor.id', ondelete='CASCADE'), primary_key=True),
+    # The primary key already serves lookups by movie_id
+    Index('ix_movie_cast_actor_id', 'actor_id')
+)
+
+
+def get_cast(movie_id):
+    """Return the actors cast in a movie, or None if there is no such
+    movie."""
+    if db.session.query(Movie.id).filter(
+            Movie.id == movie_id, Movie.deleted_at.is_(None)).first() is None:
+        return None
+    return Actor.query.join(movie_cast, movie_cast.c.actor_id == Actor.id) \
+        .filter(movie_cast.c.movie_id == movie_id) \
+        .order_by(Actor.id).all()
+
+
+def get_filmography(actor_id):
+    """Return the movies an actor is cast in, or None if there is no such
+    actor."""
+    if db.session.query(Actor.id).filter(
+            Actor.id == actor_id, Actor.deleted_at.is_(None)).first() is None:
+        return None
+    return Movie.query.join(movie_cast, movie_cast.c.movie_id == Movie.id) \
+        .filter(movie_cast.c.actor_id == actor_id) \
+        .order_by(Movie.id).all()
+
+
+def touch_cast(movie_id, actor_ids):
+    # A cast change updates the movie and the actors, so that clients
+    # syncing them with the cast included pick it up
+    changes = ((Movie, [movie_id]), (Actor, actor_ids))
+    times = bump_versions(model.__tablename__ for model, ids in changes)
+    for model, ids in changes:
+        table = model.__table__
+        db.session.execute(table.update().where(id_in(table, ids))
+                           .values(updated_at=times[table.name]))
+        record_change(table.name, 'update', ids)
+
+
+def add_cast(movie_id, actor_ids):
+    """Cast actors in a movie and return the ids that were not cast in it
+    yet. Returns None if there is no such movie and raises ValueError for
+    unknown actors."""
+    try:
+        if db.session.query(Movie.id).filter(
+                Movie.id == movie_id, Movie.deleted_at.is_(None)) \
+                .with_for_update().first() is None:
+            return None
+        actor_ids = sorted(set(actor_ids))
+        table = Actor.__table__
+        found = {row.id for row in db.session.execute(
+            select([table.c.id])
+            .where(and_(id_in(table, actor_ids), live(table))))}
+        missing = [id for id in actor_ids if id not in found]
+        if missing:
+            raise ValueError('unknown actor: ' +
+                             ', '.join(str(id) for id in missing))
+        cast = {row.actor_id for row in db.session.execute(
+            select([movie_cast.c.actor_id])
+            .where(movie_cast.c.movie_id == movie_id))}
+        added = [id for id in actor_ids if id not in cast]
+        if added:
+            db.session.execute(movie_cast.insert(), [
+                {'movie_id': movie_id, 'actor_id': id} for id in added])
+            touch_cast(movie_id, added)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return added
+
+
+def remove_cast(movie_id, actor_id):
+    """Remove an actor from a movie's cast. Returns False if the actor was
+    not cast in the movie."""
+    try:
+        result = db.session.execute(movie_cast.delete().where(and_(
+            movie_cast.c.movie_id == movie_id,
+            movie_cast.c.actor_id == actor_id)))
+        if result.rowcount:
+            touch_cast(movie_id, [actor_id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount > 0
 
 
 # Movies
 
 
 class Movie(db.Model):
+    # Prefix searches use the title index, substring searches use the
+    # trigram index created by the migrations on PostgreSQL
+    __table_args__ = (
+        Index('ix_movie_title', 'title',
+              postgresql_ops={'title': 'text_pattern_ops'}),
+        # Sync queries walk the changes in (updated_at, id) order
+        Index('ix_movie_updated_at', 'updated_at', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
-    release_date = Column(Date)
+    release_date = Column(Date, index=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    deleted_at = Column(DateTime)
+    cast = relationship('Actor', secondary=movie_cast,
+                        back_populates='movies', order_by='Actor.id',
+                        passive_deletes=True)
+
+    fields = ('id', 'title', 'release_date')
+    includes = ('cast',)
+    validators = {
+        'title': text_value,
+        'release_date': date_value
+    }
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    @classmethod
+    def validate(cls, data, partial=False):
+        return validate_fields(data, cls.validators, partial)
+
     def format(self):
         return {
             'id': self.id,
@@ -37,31 +557,59 @@ class Movie(db.Model):
         }
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        delete_rows(type(self), [type(self).id == self.id])
 
     def insert(self):
+        self.updated_at = bump_version(self.__tablename__)
         db.session.add(self)
+        db.session.flush()
+        record_change(self.__tablename__, 'insert', [self.id])
         db.session.commit()
 
     def update(self):
+        self.updated_at = bump_version(self.__tablename__)
+        record_change(self.__tablename__, 'update', [self.id])
         db.session.commit()
 
 # Actors
 
 
 class Actor(db.Model):
+    # Prefix searches use the name index, substring searches use the
+    # trigram index created by the migrations on PostgreSQL
+    __table_args__ = (
+        Index('ix_actor_name', 'name',
+              postgresql_ops={'name': 'text_pattern_ops'}),
+        Index('ix_actor_updated_at', 'updated_at', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
-    age = Column(Integer)
+    age = Column(Integer, index=True)
     gender = Column(String)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    deleted_at = Column(DateTime)
+    movies = relationship('Movie', secondary=movie_cast,
+                          back_populates='cast', order_by='Movie.id',
+                          passive_deletes=True)
+
+    fields = ('id', 'name', 'age', 'gender')
+    includes = ('movies',)
+    validators = {
+        'name': text_value,
+        'age': int_value,
+        'gender': text_value
+    }
 
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    @classmethod
+    def validate(cls, data, partial=False):
+        return validate_fields(data, cls.validators, partial)
+
     def format(self):
         return {
             'id': self.id,
@@ -71,12 +619,16 @@ class Actor(db.Model):
         }
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        delete_rows(type(self), [type(self).id == self.id])
 
     def insert(self):
+        self.updated_at = bump_version(self.__tablename__)
         db.session.add(self)
+        db.session.flush()
+        record_change(self.__tablename__, 'insert', [self.id])
         db.session.commit()
 
     def update(self):
+        self.updated_at = bump_version(self.__tablename__)
+        record_change(self.__tablename__, 'update', [self.id])
         db.session.commit()
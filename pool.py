@@ -0,0 +1,87 @@
+import os
+import time
+import weakref
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+from metrics import Counter, Gauge, Histogram
+
+# Connection pool settings and metrics
+
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def engine_options(database_path, name='primary'):
+    """SQLAlchemy engine options for ``database_path``, read from the
+    environment."""
+    options = {
+        # Managed Postgres drops idle connections, test them on checkout
+        # and replace them before the server side timeout
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_logging_name': name
+    }
+    if not database_path.startswith('sqlite'):
+        options.update({
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30))
+        })
+    return options
+
+
+pool_checkout_seconds = Histogram(
+    'db_pool_checkout_seconds',
+    'Time spent waiting for a database connection from the pool',
+    ['pool'])
+pool_timeouts = Counter(
+    'db_pool_timeouts_total',
+    'Connection checkouts that timed out waiting for the pool',
+    ['pool'])
+pool_connections = Gauge(
+    'db_pool_connections',
+    'Database connections by state',
+    ['pool', 'state'])
+
+pools = weakref.WeakSet()
+
+
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pools.add(self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_timeouts.inc(pool=self.logging_name)
+            raise
+        finally:
+            pool_checkout_seconds.observe(
+                time.perf_counter() - start, pool=self.logging_name)
+
+    def recreate(self):
+        pool = super().recreate()
+        pools.discard(self)
+        return pool
+
+
+def pool_states():
+    values = {}
+    for pool in list(pools):
+        name = pool.logging_name
+        values[(name, 'checked_out')] = pool.checkedout()
+        values[(name, 'checked_in')] = pool.checkedin()
+        values[(name, 'overflow')] = max(pool.overflow(), 0)
+        values[(name, 'size')] = pool.size()
+    return values
+
+
+pool_connections.set_function(pool_states)
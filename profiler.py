@@ -0,0 +1,193 @@
+import os
+import sys
+import hmac
+import time
+import uuid
+import random
+import marshal
+import cProfile
+import threading
+import collections
+from flask import g, request
+from metrics import Counter
+
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sampling')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_BUFFER_SIZE = int(os.environ.get('PROFILE_BUFFER_SIZE', 20))
+PROFILE_PERMISSION = 'profile:requests'
+
+# Request profiler
+# A request is profiled when it carries X-Profile with the PROFILE_TOKEN,
+# when it carries X-Profile and its bearer token grants PROFILE_PERMISSION,
+# or when it is picked at PROFILE_SAMPLE_RATE. Other requests only pay for
+# a header lookup.
+
+profiles_total = Counter(
+    'profiles_total', 'Requests profiled, by what triggered them',
+    ['trigger'])
+
+
+class SamplingProfiler:
+    """Samples the stack of the profiled thread every ``interval`` seconds
+    and counts the collapsed stacks, the input format of flamegraph.pl."""
+
+    format = 'collapsed'
+    mimetype = 'text/plain'
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._sampler = threading.Thread(
+            target=self._sample, name='profiler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def dump(self):
+        return ''.join('%s %d\n' % item
+                       for item in sorted(self.stacks.items())).encode()
+
+
+class DeterministicProfiler:
+    """cProfile, dumped in the pstats format (load it with
+    ``pstats.Stats(path)``)."""
+
+    format = 'pstats'
+    mimetype = 'application/octet-stream'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self):
+        self.profile.create_stats()
+        return marshal.dumps(self.profile.stats)
+
+
+PROFILERS = {
+    'sampling': SamplingProfiler,
+    'cprofile': DeterministicProfiler
+}
+
+
+class ProfileStore:
+    """Ring buffer of the last ``maxlen`` profiles."""
+
+    def __init__(self, maxlen=PROFILE_BUFFER_SIZE):
+        self._profiles = collections.deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles.append(profile)
+
+    def list(self):
+        with self._lock:
+            return [{key: value for key, value in profile.items()
+                     if key not in ('data', 'mimetype')}
+                    for profile in reversed(self._profiles)]
+
+    def get(self, profile_id):
+        with self._lock:
+            for profile in self._profiles:
+                if profile['id'] == profile_id:
+                    return profile
+        return None
+
+
+profile_store = ProfileStore()
+
+
+def start_profile(trigger):
+    if g.get('profiler') is not None:
+        return
+    profiler = PROFILERS[PROFILE_MODE]()
+    g.profiler = profiler
+    g.profile_trigger = trigger
+    g.profile_start = time.time()
+    profiler.start()
+
+
+def stop_profile(status):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+    profiler.stop()
+    profile = {
+        'id': uuid.uuid4().hex,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'route': request.url_rule.rule if request.url_rule else None,
+        'status': status,
+        'trigger': g.profile_trigger,
+        'started': g.profile_start,
+        'duration': time.time() - g.profile_start,
+        'format': profiler.format,
+        'mimetype': profiler.mimetype,
+        'data': profiler.dump()
+    }
+    profile_store.add(profile)
+    profiles_total.inc(trigger=g.profile_trigger)
+    return profile
+
+
+def profile_permitted(permissions):
+    """Start profiling a request that asked for it once its token is
+    verified and grants PROFILE_PERMISSION. Called by require_permission."""
+    if 'X-Profile' in request.headers and PROFILE_PERMISSION in permissions:
+        start_profile('permission')
+
+
+def init_profiler(app):
+    if PROFILE_MODE not in PROFILERS:
+        raise ValueError('PROFILE_MODE must be one of %s' % ', '.join(
+            PROFILERS))
+
+    @app.before_request
+    def start_profiler():
+        header = request.headers.get('X-Profile')
+        if header is not None and PROFILE_TOKEN and \
+                hmac.compare_digest(header.encode(), PROFILE_TOKEN.encode()):
+            start_profile('header')
+        elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            start_profile('sample')
+
+    @app.after_request
+    def stop_profiler(response):
+        profile = stop_profile(response.status_code)
+        if profile is not None:
+            response.headers['X-Profile-Id'] = profile['id']
+        return response
+
+    @app.teardown_request
+    def stop_failed_profiler(error):
+        # after_request is skipped when the view raised
+        if g.get('profiler') is not None:
+            stop_profile(500)
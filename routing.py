@@ -0,0 +1,171 @@
+import os
+import time
+import itertools
+import threading
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, BaseQuery
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+from metrics import Counter
+from pool import engine_options
+
+REPLICA_COOLDOWN = int(os.environ.get('DB_REPLICA_COOLDOWN', 30))
+READ_METHODS = ('GET', 'HEAD')
+
+# Read replica routing
+
+replica_reads = Counter(
+    'db_replica_reads_total',
+    'Statements of read requests routed to a read replica',
+    ['replica'])
+replica_failures = Counter(
+    'db_replica_failures_total',
+    'Read replicas taken out of rotation after a connection error',
+    ['replica'])
+
+
+class ReplicaRouter:
+    """Hands out read replica engines round-robin or by fewest checked out
+    connections, skipping replicas that recently failed."""
+
+    def __init__(self, urls, strategy='round_robin',
+                 cooldown=REPLICA_COOLDOWN):
+        if strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError('unknown replica strategy: ' + strategy)
+        self.urls = list(urls)
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self._engines = {}
+        self._unhealthy_until = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def engine(self, name):
+        engine = self._engines.get(name)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(name)
+                if engine is None:
+                    url = self.urls[int(name.rsplit('_', 1)[1])]
+                    engine = create_engine(url, **engine_options(url, name))
+                    event.listen(
+                        engine, 'handle_error',
+                        lambda context: self._on_error(name, engine, context))
+                    self._engines[name] = engine
+        return engine
+
+    def names(self):
+        return ['replica_%d' % i for i in range(len(self.urls))]
+
+    def healthy(self):
+        now = time.monotonic()
+        return [name for name in self.names()
+                if self._unhealthy_until.get(name, 0) <= now]
+
+    def choose(self):
+        """Return the name and engine of a replica, or None if every
+        replica is unhealthy."""
+        names = self.healthy()
+        if not names:
+            return None
+        if self.strategy == 'least_loaded':
+            name = min(names, key=lambda name: self.load(name))
+        else:
+            name = names[next(self._counter) % len(names)]
+        return name, self.engine(name)
+
+    def load(self, name):
+        engine = self._engines.get(name)
+        if engine is None:
+            return 0
+        checkedout = getattr(engine.pool, 'checkedout', None)
+        return checkedout() if checkedout else 0
+
+    def mark_unhealthy(self, name):
+        self._unhealthy_until[name] = time.monotonic() + self.cooldown
+        replica_failures.inc(replica=name)
+
+    def _on_error(self, name, engine, context):
+        if context.is_disconnect or isinstance(
+                context.original_exception,
+                engine.dialect.dbapi.OperationalError):
+            self.mark_unhealthy(name)
+
+    def dispose(self):
+        for engine in self._engines.values():
+            engine.dispose()
+
+
+class RoutingSession(SignallingSession):
+    """Sends the reads of GET and HEAD requests to a read replica. Writes,
+    and every statement of a request after its first write, go to the
+    primary. A read that fails on its replica is run again on the
+    primary."""
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replicas')
+        if router is not None and has_request_context() and \
+                request.method in READ_METHODS and \
+                not g.get('db_primary'):
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.db_primary = True
+            else:
+                # Keep every read of a request on the same replica
+                name = g.get('db_replica')
+                if name is None or name not in router.healthy():
+                    replica = router.choose()
+                    name = g.db_replica = replica and replica[0]
+                if name is not None:
+                    replica_reads.inc(replica=name)
+                    return router.engine(name)
+        return super().get_bind(mapper, clause)
+
+    def execute(self, *args, **kwargs):
+        try:
+            return super().execute(*args, **kwargs)
+        except DBAPIError as e:
+            if not self.fall_back_to_primary(e):
+                raise
+        return super().execute(*args, **kwargs)
+
+    def fall_back_to_primary(self, error):
+        """Send the rest of the request to the primary if ``error`` is a
+        connection failure of its replica. Return False otherwise."""
+        if not has_request_context() or not g.get('db_replica') or \
+                g.get('db_primary'):
+            return False
+        if not error.connection_invalidated and \
+                not isinstance(error, OperationalError):
+            return False
+        g.db_primary = True
+        # Only reads ran, so nothing is lost with the replica connection
+        self.rollback()
+        return True
+
+
+class RoutingQuery(BaseQuery):
+    def __iter__(self):
+        try:
+            return super().__iter__()
+        except DBAPIError as e:
+            if not self.session.fall_back_to_primary(e):
+                raise
+        return super().__iter__()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def __init__(self, *args, query_class=RoutingQuery, **kwargs):
+        super().__init__(*args, query_class=query_class, **kwargs)
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_replicas(app, urls, strategy='round_robin'):
+    router = app.extensions.pop('replicas', None)
+    if router is not None:
+        router.dispose()
+    if urls:
+        app.extensions['replicas'] = ReplicaRouter(urls, strategy)
@@ -1,23 +1,75 @@
 import os
 import unittest
 import json
+import time
+import tempfile
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
 from app import create_app
-from models import setup_db, Movie, Actor
+from models import (db, Movie, Actor, insert_rows, update_rows, delete_rows,
+                    record_change, bump_version, bump_versions,
+                    get_version, purge_tombstones)
+from sqlalchemy import inspect
+from auth import JWKSKeyStore, TokenCache, AuthError
+from routing import ReplicaRouter, init_replicas
+from cache import LRUCache, FileCacheBackend, ResponseCache
+from benchmarks.tokens import LocalIssuer, KID, ROLES
+import auth
+import profiler
+import fastjson
+import gzip
+import zlib
+from compression import compress_chunks
+import listing
+from listing import Serializer
+from groupcommit import batch_failures, GroupCommitTimeout
+from admission import (RateLimiter, AdmissionController, AdmissionError,
+                       admission_total)
+from changes import (LocalBroker, PostgresBroker, format_event,
+                     stream_changes)
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from benchmarks.common import percentile, regressions
+
+# Local tokens
+# The SQLite test cases verify tokens minted by a local issuer, so they run
+# without Auth0 or the CASTING_* environment.
+
+local_issuer = None
+
+
+def use_local_tokens(test):
+    """Verify tokens against the local issuer until ``test`` ends. Return
+    the Authorization header of each role."""
+    global local_issuer
+    if local_issuer is None:
+        local_issuer = LocalIssuer(bits=1024)
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    store = JWKSKeyStore(local_issuer.write_jwks(
+        os.path.join(directory.name, 'jwks.json')))
+    patcher = mock.patch.object(auth, 'jwks_store', store)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return {role: {'Authorization': 'Bearer ' + local_issuer.token(perms)}
+            for role, perms in ROLES.items()}
+
 
 # Casting Agency test case
 
 
 class CastingAgencyTestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
-        self.client = self.app.test_client()
         self.database_name = "casting_agency_test"
         self.database_path = "postgresql://{}/{}".format(
             'localhost:5432',
             self.database_name
         )
-        setup_db(self.app, self.database_path)
+        self.app = create_app({
+            'DATABASE_URL': self.database_path,
+            'DB_CREATE_ALL': True
+        })
+        self.client = self.app.test_client()
 
         with self.app.app_context():
             self.db = SQLAlchemy()
@@ -46,6 +98,93 @@ class CastingAgencyTestCase(unittest.TestCase):
         )
         self.assertEqual(res.status_code, 200)
 
+    # Get one page of actors with selected fields
+
+    def test2a_get_actors_page_with_fields(self):
+        res = self.client.get(
+            '/actors?limit=1&fields=name',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data['actors']), 1)
+        self.assertIn('next', data)
+        for actor in data['actors']:
+            self.assertEqual(set(actor), {'id', 'name'})
+
+    # Get actors with an invalid page size
+
+    def test2b_get_actors_with_invalid_limit(self):
+        res = self.client.get(
+            '/actors?limit=0',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    # Stream all actors
+
+    def test2c_stream_actors(self):
+        res = self.client.get(
+            '/actors?stream=true',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        self.assertTrue(res.is_streamed)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIsInstance(data['actors'], list)
+
+    # Get actors again with the ETag of the previous response
+
+    def test2d_get_actors_not_modified(self):
+        headers = {
+            "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+        }
+        res = self.client.get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        etag = res.headers['ETag']
+
+        res = self.client.get(
+            '/actors',
+            headers=dict(headers, **{"If-None-Match": etag})
+        )
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    # Search actors by name prefix and age range
+
+    def test2e_get_actors_filtered(self):
+        res = self.client.get(
+            '/actors?name__prefix=Al&age__gte=18&age__lt=65',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertTrue(actor['name'].startswith('Al'))
+            self.assertTrue(18 <= actor['age'] < 65)
+
+    # Filter actors on an unknown field
+
+    def test2f_get_actors_with_unknown_filter(self):
+        res = self.client.get(
+            '/actors?height__gte=180',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        self.assertEqual(res.status_code, 400)
+
     # Add actor without permission
 
     def test3_add_a_actor_without_valid_authorization_token(self):
@@ -80,6 +219,39 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    # Add actors in bulk, one row is invalid
+
+    def test4a_add_actors_in_bulk(self):
+        res = self.client.post(
+            '/actors/bulk',
+            json=[
+                {"name": "Bob", "age": 30, "gender": "Male"},
+                {"name": "Carol", "age": "string", "gender": "Female"}
+            ],
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_DIRECTOR')}",
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['ids']), 2)
+        self.assertIsNotNone(data['ids'][0])
+        self.assertIsNone(data['ids'][1])
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+    # Add movies in bulk from NDJSON without permission
+
+    def test4b_add_movies_in_bulk_without_permission(self):
+        res = self.client.post(
+            '/movies/bulk',
+            data='{"title": "Up", "release_date": "2009-05-29"}\n',
+            content_type='application/x-ndjson',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_DIRECTOR')}",
+            }
+        )
+        self.assertEqual(res.status_code, 403)
+
     # Unprocessable entity
 
     def test5_unprocessable(self):
@@ -98,6 +270,53 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertFalse(data['success'])
 
+    # Update actors in bulk by filter
+
+    def test5a_update_actors_in_bulk(self):
+        res = self.client.patch(
+            '/actors/bulk',
+            json={
+                "filter": {"name": "Bob", "age": {"gte": 18}},
+                "values": {"age": 31}
+            },
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_DIRECTOR')}",
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIsInstance(data['ids'], list)
+
+    # Update actors in bulk with invalid values
+
+    def test5aa_update_actors_in_bulk_unprocessable(self):
+        res = self.client.patch(
+            '/actors/bulk',
+            json={
+                "filter": {"name": "Bob"},
+                "values": {"age": "old"}
+            },
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_DIRECTOR')}",
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    # Delete actors in bulk without ids or filter
+
+    def test5b_delete_actors_in_bulk_without_criteria(self):
+        res = self.client.delete(
+            '/actors/bulk',
+            json={},
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_DIRECTOR')}",
+            }
+        )
+        self.assertEqual(res.status_code, 400)
+
     # Update actor information without permission
 
     def test6_update_a_actor_without_valid_authorization_token(self):
@@ -128,6 +347,22 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    # Update actor that does not exist
+
+    def test7a_update_a_missing_actor(self):
+        res = self.client.patch(
+            '/actors/100000',
+            json={
+                "age": 26,
+            },
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_DIRECTOR')}",
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
     # Delete actor without permission
 
     def test8_delete_a_actor_without_valid_authorization_token(self):
@@ -152,6 +387,30 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    # Delete actor that does not exist
+
+    def test9a_delete_a_missing_actor(self):
+        res = self.client.delete(
+            '/actors/100000',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_DIRECTOR')}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    # Get the movies of an actor that does not exist
+
+    def test9b_get_movies_of_a_missing_actor(self):
+        res = self.client.get(
+            '/actors/100000/movies',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        self.assertEqual(res.status_code, 404)
+
     # Begin movies endpoints test
 
     # Get movies information without permission
@@ -171,6 +430,20 @@ class CastingAgencyTestCase(unittest.TestCase):
         )
         self.assertEqual(res.status_code, 200)
 
+    # Get movies with their cast
+
+    def test11a_get_movies_with_cast(self):
+        res = self.client.get(
+            '/movies?include=cast',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for movie in data['movies']:
+            self.assertIsInstance(movie['cast'], list)
+
     # Add movies without permission
 
     def test12_add_a_movie_without_valid_authorization_token(self):
@@ -204,6 +477,34 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    # Cast an actor in a movie without permission
+
+    def test13a_add_movie_cast_without_valid_authorization_token(self):
+        res = self.client.post(
+            '/movies/1/cast',
+            json={
+                "actor_ids": [1]
+            },
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        self.assertEqual(res.status_code, 403)
+
+    # Cast an actor that does not exist
+
+    def test13b_add_missing_actor_to_movie_cast(self):
+        res = self.client.post(
+            '/movies/1/cast',
+            json={
+                "actor_ids": [100000]
+            },
+            headers={
+                "Authorization": f"Bearer {os.getenv('EXECUTIVE_PRODUCER')}"
+            }
+        )
+        self.assertEqual(res.status_code, 422)
+
     # Update movies information without permission
 
     def test14_update_a_movie_without_valid_authorization_token(self):
@@ -256,6 +557,711 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+    # Metrics endpoint
+
+    def test18_get_metrics(self):
+        res = self.client.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'db_pool_connections', res.data)
+
+    def test18a_metrics_token(self):
+        os.environ['METRICS_TOKEN'] = 'secret'
+        try:
+            res = self.client.get('/metrics', headers={
+                "Authorization": "Bearer wrong"})
+            self.assertEqual(res.status_code, 401)
+            res = self.client.get('/metrics', headers={
+                "Authorization": "Bearer secret"})
+            self.assertEqual(res.status_code, 200)
+        finally:
+            del os.environ['METRICS_TOKEN']
+
+    def test18b_profile_request_with_profile_token(self):
+        profiler.PROFILE_TOKEN = 'secret'
+        try:
+            res = self.client.get(
+                '/actors',
+                headers={
+                    "Authorization":
+                    f"Bearer {os.getenv('CASTING_ASSISTANT')}",
+                    "X-Profile": "secret"
+                }
+            )
+        finally:
+            profiler.PROFILE_TOKEN = None
+        self.assertEqual(res.status_code, 200)
+        profile = profiler.profile_store.get(res.headers['X-Profile-Id'])
+        self.assertEqual(profile['trigger'], 'header')
+        self.assertEqual(profile['route'], '/actors')
+
+    def test18c_download_profile_without_permission(self):
+        res = self.client.get(
+            '/profiles',
+            headers={
+                "Authorization": f"Bearer {os.getenv('EXECUTIVE_PRODUCER')}"
+            }
+        )
+        self.assertEqual(res.status_code, 403)
+
+    def test18d_gzip_compressed_response(self):
+        res = self.client.get('/metrics', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertIn(b'db_pool_connections', gzip.decompress(res.data))
+
+    def test18e_request_timing(self):
+        res = self.client.get(
+            '/actors',
+            headers={
+                "Authorization": f"Bearer {os.getenv('CASTING_ASSISTANT')}"
+            }
+        )
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+
+        res = self.client.get('/metrics')
+        self.assertIn(b'http_request_duration_seconds_count{method="GET",'
+                      b'route="/actors",status="200"}', res.data)
+        self.assertIn(b'db_queries_per_request_count{route="/actors"}',
+                      res.data)
+        self.assertIn(b'auth_step_seconds_count{step="check_permission"}',
+                      res.data)
+
+
+# Startup test case
+
+
+class StartupTestCase(unittest.TestCase):
+    def test_create_app_leaves_the_schema_to_migrations(self):
+        app = create_app({'DATABASE_URL': 'sqlite://'})
+        with app.app_context():
+            self.assertEqual(inspect(db.engine).get_table_names(), [])
+
+        app = create_app({'DATABASE_URL': 'sqlite://', 'DB_CREATE_ALL': True})
+        with app.app_context():
+            self.assertIn('actor', inspect(db.engine).get_table_names())
+
+    def test_create_all_leaves_no_session_behind(self):
+        create_app({'DATABASE_URL': 'sqlite://', 'DB_CREATE_ALL': True})
+        # A leftover session would serve the next app of this thread
+        self.assertFalse(db.session.registry.has())
+
+
+# Group commit test case
+
+
+class GroupCommitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + self.db_file.name,
+            'DB_CREATE_ALL': True,
+            'GROUP_COMMIT': True
+        })
+        self.committer = self.app.extensions['group_commit']
+        self.committer.interval = 0.2
+
+    def tearDown(self):
+        os.remove(self.db_file.name)
+
+    def insert(self, values):
+        try:
+            return self.committer.insert(Actor, values)
+        except Exception as e:
+            return e
+
+    def test_concurrent_inserts_share_a_commit(self):
+        rows = [{'name': 'Actor %d' % i, 'age': 30, 'gender': 'Other'}
+                for i in range(5)]
+        with ThreadPoolExecutor(5) as pool:
+            ids = list(pool.map(self.insert, rows))
+        self.assertEqual(len(set(ids)), 5)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 5)
+            self.assertEqual(Actor.query.get(ids[3]).name, 'Actor 3')
+
+    def test_failed_write_does_not_fail_the_batch(self):
+        first = self.insert({'name': 'First', 'age': 30, 'gender': 'Other'})
+        failures = batch_failures._values.get((), 0)
+        rows = [{'name': 'Actor %d' % i, 'age': 30, 'gender': 'Other'}
+                for i in range(3)]
+        rows.append({'id': first, 'name': 'Duplicate'})
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(self.insert, rows))
+        self.assertIsInstance(results[3], Exception)
+        self.assertTrue(all(isinstance(id, int) for id in results[:3]))
+        self.assertEqual(batch_failures._values.get((), 0), failures + 1)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 4)
+
+    def test_failed_flush_fails_its_writes_only(self):
+        commit = self.committer._commit
+        self.committer._commit = lambda batch: 1 / 0
+        result = self.insert({'name': 'Lost', 'age': 30, 'gender': 'Other'})
+        self.assertIsInstance(result, ZeroDivisionError)
+        self.committer._commit = commit
+        self.assertIsInstance(
+            self.insert({'name': 'Kept', 'age': 30, 'gender': 'Other'}), int)
+
+    def test_update_matching_nothing_keeps_the_version(self):
+        with self.app.app_context():
+            before = get_version('actor')
+        self.assertEqual(self.committer.update(
+            Actor, {'age': 31}, [Actor.id == 999]), [])
+        with self.app.app_context():
+            self.assertEqual(get_version('actor'), before)
+
+    def test_versions_are_bumped_in_name_order(self):
+        with self.app.app_context(), mock.patch(
+                'models.bump_version', side_effect=lambda name: name) as bump:
+            bump_versions(['movie', 'actor', 'movie'])
+        self.assertEqual([c.args[0] for c in bump.call_args_list],
+                         ['actor', 'movie'])
+
+    def test_slow_commit_times_out_with_503(self):
+        self.committer.timeout = 0.05
+        client = self.app.test_client()
+        headers = use_local_tokens(self)['CASTING_DIRECTOR']
+        res = client.post('/actors', headers=headers, json={
+            'name': 'Slow', 'age': 30, 'gender': 'Other'})
+        self.assertEqual(res.status_code, 503)
+        self.assertRaises(GroupCommitTimeout, self.committer.insert, Actor,
+                          {'name': 'Slow', 'age': 30, 'gender': 'Other'})
+
+    def test_invalid_write_is_not_queued(self):
+        client = self.app.test_client()
+        headers = use_local_tokens(self)['CASTING_DIRECTOR']
+        res = client.post('/actors', headers=headers, json={
+            'name': 'Old', 'age': -1, 'gender': 'Other'})
+        self.assertEqual(res.status_code, 422)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 0)
+
+
+# Admission control test case
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def test_rate_limit_per_subject(self):
+        limiter = RateLimiter(rate=1, burst=2)
+        self.assertEqual(limiter.take('a'), 0)
+        self.assertEqual(limiter.take('a'), 0)
+        self.assertGreater(limiter.take('a'), 0)
+        self.assertEqual(limiter.take('b'), 0)
+
+    def test_heavy_reads_are_shed_after_the_deadline(self):
+        controller = AdmissionController(rate=0, max_heavy=1,
+                                         queue_timeout=0.01)
+        shed = admission_total.get(outcome='shed')
+        app = create_app({'DATABASE_URL': 'sqlite://'})
+        with app.app_context():
+            controller.admit('a', heavy=True)
+            with app.app_context():
+                with self.assertRaises(AdmissionError) as error:
+                    controller.admit('b', heavy=True)
+                controller.admit('b')
+        self.assertEqual(error.exception.status_code, 503)
+        self.assertEqual(admission_total.get(outcome='shed'), shed + 1)
+        controller.heavy.release()
+        self.assertEqual(controller.heavy.acquire(), 'admitted')
+
+    def test_rate_limited_response(self):
+        app = create_app({
+            'DATABASE_URL': 'sqlite://',
+            'DB_CREATE_ALL': True,
+            'ADMISSION_RATE': 0.001,
+            'ADMISSION_BURST': 1
+        })
+        client = app.test_client()
+        headers = use_local_tokens(self)['CASTING_ASSISTANT']
+        self.assertEqual(client.get('/actors', headers=headers).status_code,
+                         200)
+        res = client.get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 429)
+        self.assertGreater(int(res.headers['Retry-After']), 0)
+        self.assertEqual(res.get_json()['code'], 429)
+
+
+# Change feed test case
+
+
+class ChangeFeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite://',
+            'DB_CREATE_ALL': True,
+            'CHANGES_BROKER': 'local'
+        })
+        self.broker = self.app.extensions['changes']
+
+    def test_committed_writes_are_published(self):
+        subscription = self.broker.subscribe()
+        with self.app.app_context():
+            ids = insert_rows(Actor, [{'name': 'A', 'age': 30,
+                                       'gender': 'Other'}])
+            record_change('actor', 'update', ids)
+            db.session.rollback()
+        change = subscription.queue.get(timeout=1)
+        self.assertEqual((change['table'], change['op'], change['ids']),
+                         ('actor', 'insert', ids))
+        self.assertTrue(subscription.queue.empty())
+        self.assertIn('id: %s\nevent: change\n' % change['id'],
+                      format_event(change))
+
+    def test_stream_needs_a_concurrent_worker(self):
+        client = self.app.test_client()
+        headers = use_local_tokens(self)['CASTING_ASSISTANT']
+        res = client.get('/changes', headers=headers)
+        self.assertEqual(res.status_code, 503)
+        res = client.get('/changes', headers=headers,
+                         environ_overrides={'wsgi.multithread': True})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        res.close()
+
+    def test_one_notify_payload_per_commit(self):
+        changes = [{'table': 'actor', 'op': 'insert', 'ids': [1]},
+                   {'table': 'movie', 'op': 'update', 'ids': [2]}]
+        events = json.loads(PostgresBroker.payload(changes))
+        self.assertEqual([event['ids'] for event in events], [[1], [2]])
+        changes = [{'table': 'actor', 'op': 'update', 'ids': list(range(500))}
+                   for i in range(5)]
+        events = json.loads(PostgresBroker.payload(changes))
+        self.assertEqual([event['ids'] for event in events], [None] * 5)
+
+    def test_resume_from_last_event_id(self):
+        broker = LocalBroker(buffer_size=2)
+        broker.after_commit([{'table': 'actor', 'op': 'insert', 'ids': [i]}
+                             for i in range(3)])
+        first, second = broker._buffer
+        subscription = broker.subscribe(first['id'])
+        self.assertEqual(subscription.queue.get_nowait(), second)
+        subscription = broker.subscribe('evicted')
+        self.assertIsNone(subscription.queue.get_nowait())
+        self.assertEqual(format_event(None), 'event: reset\ndata: {}\n\n')
+
+    def test_slow_subscriber_is_dropped(self):
+        broker = LocalBroker(queue_size=2)
+        subscription = broker.subscribe()
+        broker.after_commit([{'table': 'actor', 'op': 'insert', 'ids': [i]}
+                             for i in range(3)])
+        self.assertTrue(subscription.dropped)
+        self.assertEqual(broker.subscriber_count(), 0)
+        self.assertEqual(subscription.queue.qsize(), 2)
+
+    def test_unsent_stream_leaves_no_subscription(self):
+        with self.app.test_request_context(
+                '/changes', environ_overrides={'wsgi.multithread': True}):
+            response = stream_changes()
+        self.assertEqual(self.broker.subscriber_count(), 0)
+        body = response.response
+        next(body)
+        self.assertEqual(self.broker.subscriber_count(), 1)
+        body.close()
+        self.assertEqual(self.broker.subscriber_count(), 0)
+
+
+# Pagination test case
+
+
+class PaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite://',
+            'DB_CREATE_ALL': True
+        })
+        self.client = self.app.test_client()
+        self.headers = use_local_tokens(self)['CASTING_ASSISTANT']
+        with self.app.app_context():
+            self.ids = insert_rows(Actor, [
+                {'name': name, 'age': 30, 'gender': 'Other'}
+                for name in ('A', 'B', 'C')])
+        page_size = listing.PAGE_SIZE
+        listing.PAGE_SIZE = 2
+        self.addCleanup(setattr, listing, 'PAGE_SIZE', page_size)
+
+    def test_plain_get_returns_the_first_page(self):
+        data = self.client.get('/actors', headers=self.headers).get_json()
+        self.assertEqual([a['id'] for a in data['actors']], self.ids[:2])
+        self.assertEqual(data['next'], self.ids[1])
+
+    def test_stream_returns_the_whole_collection(self):
+        res = self.client.get('/actors?stream=true', headers=self.headers)
+        self.assertEqual([a['id'] for a in json.loads(res.data)['actors']],
+                         self.ids)
+
+    def test_after_pages_with_the_default_size(self):
+        data = self.client.get('/actors?after=0',
+                               headers=self.headers).get_json()
+        self.assertEqual([a['id'] for a in data['actors']], self.ids[:2])
+        self.assertEqual(data['next'], self.ids[1])
+
+
+# Delta sync test case
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite://',
+            'DB_CREATE_ALL': True
+        })
+        self.client = self.app.test_client()
+        self.headers = use_local_tokens(self)['CASTING_ASSISTANT']
+
+    def sync(self, since, limit=100):
+        res = self.client.get('/actors?since=%s&limit=%d' % (since, limit),
+                              headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_changes_and_tombstones_since_token(self):
+        with self.app.app_context():
+            ids = insert_rows(Actor, [
+                {'name': name, 'age': 30, 'gender': 'Other'}
+                for name in ('A', 'B', 'C')])
+        data = self.sync(0, limit=2)
+        self.assertEqual([a['id'] for a in data['actors']], ids[:2])
+        self.assertTrue(data['more'])
+        data = self.sync(data['since'])
+        self.assertEqual([a['id'] for a in data['actors']], ids[2:])
+        self.assertFalse(data['more'])
+        since = data['since']
+
+        with self.app.app_context():
+            update_rows(Actor, {'age': 31}, [Actor.id == ids[0]])
+            delete_rows(Actor, [Actor.id == ids[1]])
+        data = self.sync(since)
+        self.assertEqual(data['actors'], [
+            {'id': ids[0], 'name': 'A', 'age': 31, 'gender': 'Other'}])
+        self.assertEqual(data['deleted'], [ids[1]])
+        self.assertEqual(self.sync(data['since'])['actors'], [])
+
+        res = self.client.get('/actors', headers=self.headers)
+        self.assertNotIn(ids[1], [a['id'] for a in res.get_json()['actors']])
+
+    def test_change_times_increase(self):
+        with self.app.app_context():
+            first = bump_version('actor')
+            second = bump_version('actor')
+        self.assertGreater(second, first)
+
+    def test_recreated_database_does_not_match_old_etags(self):
+        etag = self.client.get('/actors', headers=self.headers) \
+            .headers['ETag']
+        app = create_app({'DATABASE_URL': 'sqlite://', 'DB_CREATE_ALL': True})
+        res = app.test_client().get('/actors', headers=dict(
+            self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_if_modified_since_within_the_same_second(self):
+        with self.app.app_context():
+            insert_rows(Actor, [{'name': 'A', 'age': 30, 'gender': 'Other'}])
+        res = self.client.get('/actors', headers=self.headers)
+        last_modified = res.headers['Last-Modified']
+        with self.app.app_context():
+            insert_rows(Actor, [{'name': 'B', 'age': 30, 'gender': 'Other'}])
+        res = self.client.get('/actors', headers=dict(
+            self.headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.get_json()['actors']), 2)
+
+    def test_old_tombstones_are_purged_and_old_tokens_refused(self):
+        with self.app.app_context():
+            ids = insert_rows(Actor, [
+                {'name': name, 'age': 30, 'gender': 'Other'}
+                for name in ('A', 'B')])
+            delete_rows(Actor, [Actor.id.in_(ids)])
+            month_ago = datetime.utcnow() - timedelta(days=31)
+            Actor.query.filter(Actor.id == ids[0]).update(
+                {'deleted_at': month_ago, 'updated_at': month_ago})
+            db.session.commit()
+            self.assertEqual(purge_tombstones(30)['actor'], 1)
+            self.assertEqual(db.session.query(Actor.id).all(), [(ids[1],)])
+
+        res = self.client.get('/actors?since=' + listing.sync_token(
+            month_ago), headers=self.headers)
+        self.assertEqual(res.status_code, 410)
+        self.assertEqual(self.sync(0)['deleted'], [ids[1]])
+
+    def test_invalid_since_token(self):
+        res = self.client.get('/actors?since=yesterday',
+                              headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+# JWKS key store test case
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', delete=False)
+        self.write_keys('key1')
+        self.store = JWKSKeyStore(self.jwks_file.name, ttl=3600,
+                                  min_refetch_interval=3600)
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [
+                {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'e'}
+                for kid in kids
+            ]}, f)
+
+    def test_load_keys_from_local_file(self):
+        key = self.store.get_key('key1')
+        self.assertEqual(key['kid'], 'key1')
+        self.assertEqual(key['n'], 'n')
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key('key1')
+        self.write_keys('key1', 'key2')
+        self.assertIsNone(self.store.get_key('key2'))
+
+        self.store.min_refetch_interval = 0
+        self.assertEqual(self.store.get_key('key2')['kid'], 'key2')
+
+    def test_failed_first_fetch_refuses_tokens_and_is_rate_limited(self):
+        store = JWKSKeyStore(self.jwks_file.name + '.missing',
+                             min_refetch_interval=3600)
+        with mock.patch.object(store, '_read', wraps=store._read) as read:
+            self.assertIsNone(store.get_key('key1'))
+            self.assertIsNone(store.get_key('key1'))
+        self.assertEqual(read.call_count, 1)
+
+        token = LocalIssuer(bits=512).token(['read:information'])
+        with mock.patch.object(auth, 'jwks_store', store):
+            with self.assertRaises(AuthError) as error:
+                auth.verify_decode_jwt(token)
+        self.assertEqual(error.exception.status_code, 401)
+
+    def test_unreachable_source_leaves_unknown_kid_unknown(self):
+        self.store.get_key('key1')
+        self.store.min_refetch_interval = 0
+        self.store.source = self.jwks_file.name + '.missing'
+        self.assertIsNone(self.store.get_key('key2'))
+        self.assertEqual(self.store.get_key('key1')['kid'], 'key1')
+
+
+# Verified token cache test case
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.exp = int(time.time()) + 3600
+
+    def test_cached_permissions_are_a_frozenset(self):
+        self.cache.set('a', {'exp': self.exp, 'permissions': ['read:x']})
+        payload, permissions = self.cache.get('a')
+        self.assertEqual(permissions, frozenset(['read:x']))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_expired_token_is_not_returned(self):
+        self.cache.set('a', {'exp': int(time.time()) - 1})
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_least_recently_used_token_is_evicted(self):
+        self.cache.set('a', {'exp': self.exp})
+        self.cache.set('b', {'exp': self.exp})
+        self.cache.get('a')
+        self.cache.set('c', {'exp': self.exp})
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+
+
+# Read replica router test case
+
+
+class ReplicaRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.router = ReplicaRouter(
+            ['sqlite://', 'sqlite://'], strategy='round_robin')
+
+    def test_replicas_are_used_in_turn(self):
+        names = [self.router.choose()[0] for i in range(4)]
+        self.assertEqual(
+            names, ['replica_0', 'replica_1', 'replica_0', 'replica_1'])
+
+    def test_unhealthy_replicas_are_skipped(self):
+        self.router.mark_unhealthy('replica_0')
+        self.assertEqual(self.router.choose()[0], 'replica_1')
+
+        self.router.mark_unhealthy('replica_1')
+        self.assertIsNone(self.router.choose())
+
+    def test_read_falls_back_to_the_primary(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        primary = 'sqlite:///' + os.path.join(directory.name, 'primary.db')
+        replica = 'sqlite:///' + os.path.join(directory.name, 'replica.db')
+        app = create_app({'DATABASE_URL': primary, 'DB_CREATE_ALL': True})
+        init_replicas(app, [replica])
+        router = app.extensions['replicas']
+        with app.app_context():
+            insert_rows(Actor, [{'name': 'Primary', 'age': 30,
+                                 'gender': 'Other'}])
+            # The replica answers the version lookup, then fails mid-request
+            db.metadata.create_all(router.engine('replica_0'))
+            Actor.__table__.drop(router.engine('replica_0'))
+
+        headers = use_local_tokens(self)['CASTING_ASSISTANT']
+        res = app.test_client().get('/actors?fields=id,name&limit=7',
+                                    headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['name'] for a in res.get_json()['actors']],
+                         ['Primary'])
+        self.assertEqual(router.healthy(), [])
+
+
+# Response cache test case
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(
+            max_bytes=10, backend=FileCacheBackend(self.directory.name))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_local_tier_is_bounded_by_bytes(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set(('actor',), 'a', b'12345')
+        cache.set(('actor',), 'b', b'12345')
+        cache.set(('actor',), 'c', b'123')
+        self.assertIsNone(cache.get(('actor',), 'a'))
+        self.assertEqual(cache.get(('actor',), 'b'), b'12345')
+        self.assertEqual(cache.bytes, 8)
+
+    def test_shared_tier_fills_the_local_tier(self):
+        self.cache.set(('movie',), 'key', b'data')
+        self.cache.local.invalidate('movie')
+        self.assertEqual(self.cache.get(('movie',), 'key'), b'data')
+        self.assertEqual(self.cache.local.get(('movie',), 'key'), b'data')
+
+    def test_invalidate_drops_both_tiers(self):
+        self.cache.set(('movie',), 'key', b'data')
+        self.cache.set(('actor',), 'key', b'data')
+        self.cache.invalidate('movie')
+        self.assertIsNone(self.cache.get(('movie',), 'key'))
+        self.assertEqual(self.cache.get(('actor',), 'key'), b'data')
+
+    def test_invalidate_drops_entries_that_include_the_collection(self):
+        self.cache.set(('movie', 'actor'), 'key', b'cast')
+        self.cache.invalidate('actor')
+        self.assertIsNone(self.cache.local.get(('movie', 'actor'), 'key'))
+        self.assertIsNone(self.cache.get(('movie', 'actor'), 'key'))
+
+    def test_local_tier_indexes_keys_by_collection(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set(('movie', 'actor'), 'a', b'12345')
+        cache.set(('actor',), 'b', b'12345')
+        cache.set(('movie',), 'c', b'123')
+        self.assertEqual(dict(cache._by_name), {
+            'movie': {(('movie',), 'c')},
+            'actor': {(('actor',), 'b')}})
+        cache.invalidate('actor')
+        self.assertEqual(list(cache._by_name), ['movie'])
+        self.assertEqual(cache.bytes, 3)
+
+    def test_shared_tier_removes_older_generations(self):
+        backend = self.cache.backend
+        backend.set(('actor',), 'old', b'data')
+        backend.invalidate('actor')
+        self.assertEqual(backend.generation('actor'), 1)
+        backend.set(('actor',), 'new', b'data')
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.directory.name, 'actor'))), 1)
+
+
+# Benchmark helpers test case
+
+
+class BenchmarkHelpersTestCase(unittest.TestCase):
+    def test_local_issuer_keys_are_served_as_jwks(self):
+        issuer = LocalIssuer(bits=512)
+        with tempfile.TemporaryDirectory() as directory:
+            store = JWKSKeyStore(
+                issuer.write_jwks(os.path.join(directory, 'jwks.json')))
+            self.assertEqual(store.get_key(KID)['n'],
+                             issuer.jwks['keys'][0]['n'])
+        self.assertEqual(len(issuer.token(['read:information'])
+                             .split('.')), 3)
+
+    def test_regressions_against_baseline(self):
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 3)
+        baseline = {'a': {'p95': 1.0, 'throughput': 100.0},
+                    'b': {'p95': 1.0, 'throughput': 100.0}}
+        results = {'a': {'p95': 1.05, 'throughput': 98.0},
+                   'b': {'p95': 1.5, 'throughput': 100.0},
+                   'c': {'p95': 9.0, 'throughput': 1.0}}
+        self.assertEqual(regressions(baseline, results, 0.1), ['b'])
+
+
+# Core row serializer test case
+
+
+class SerializerTestCase(unittest.TestCase):
+    def test_rows_are_serialized_in_model_field_order(self):
+        serializer = Serializer(Movie)
+        self.assertEqual(serializer.names, ('id', 'title', 'release_date'))
+        self.assertEqual(
+            serializer([(1, 'Up', date(2009, 5, 29))]),
+            [{'id': 1, 'title': 'Up', 'release_date': date(2009, 5, 29)}])
+
+    def test_selected_fields(self):
+        serializer = Serializer(Actor, ('id', 'age'))
+        self.assertEqual([c.name for c in serializer.columns], ['id', 'age'])
+        self.assertEqual(serializer([(2, 40)]), [{'id': 2, 'age': 40}])
+
+
+# Response compression test case
+
+
+class CompressionTestCase(unittest.TestCase):
+    def test_streamed_chunks_decode_as_they_arrive(self):
+        chunks = compress_chunks(iter(['{"actors":[', '{"id":1}', ']}']),
+                                 'gzip')
+        first = next(chunks)
+        decoder = zlib.decompressobj(31)
+        self.assertEqual(decoder.decompress(first), b'{"actors":[')
+        rest = b''.join(chunks)
+        self.assertEqual(gzip.decompress(first + rest),
+                         b'{"actors":[{"id":1}]}')
+
+
+# JSON backends test case
+
+
+class JSONBackendTestCase(unittest.TestCase):
+    payload = {
+        'movies': [{'id': 1, 'title': 'Amélie', 'release_date':
+                    date(2001, 4, 25)}],
+        'created': datetime(2020, 2, 16, 10, 30, 0, 250),
+        'next': None,
+        'success': True
+    }
+
+    def test_dates_are_iso_strings(self):
+        data = json.loads(fastjson.StdlibBackend().dumps(self.payload))
+        self.assertEqual(data['movies'][0]['release_date'], '2001-04-25')
+        self.assertEqual(data['created'], '2020-02-16T10:30:00.000250')
+
+    @unittest.skipIf(fastjson.orjson is None, 'orjson is not installed')
+    def test_backends_are_byte_identical(self):
+        stdlib = fastjson.StdlibBackend()
+        fast = fastjson.OrjsonBackend()
+        for pretty in (False, True):
+            self.assertEqual(stdlib.dumps(self.payload, pretty=pretty),
+                             fast.dumps(self.payload, pretty=pretty))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,118 @@
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from metrics import Histogram
+from pool import env_flag
+
+SERVER_TIMING = env_flag('SERVER_TIMING', True)
+
+# Request timing
+# Each request collects the time spent in its steps (auth, SQL, JWKS
+# fetch, serialization) in g.timings. They are exported as Prometheus
+# histograms and in a Server-Timing header.
+
+request_seconds = Histogram(
+    'http_request_duration_seconds', 'Request latency by route',
+    ['method', 'route', 'status'])
+request_queries = Histogram(
+    'db_queries_per_request', 'SQL statements executed per request',
+    ['route'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250))
+request_query_seconds = Histogram(
+    'db_query_seconds_per_request', 'Time spent in SQL statements per '
+    'request', ['route'])
+auth_seconds = Histogram(
+    'auth_step_seconds', 'Time spent in each authorization step', ['step'])
+jwks_fetch_seconds = Histogram(
+    'jwks_fetch_seconds', 'Time spent fetching the JWKS signing keys')
+
+# Server-Timing metric names of the steps, in header order
+STEPS = (
+    ('auth_header', 'get_token_auth_header'),
+    ('jwks', 'JWKS fetch'),
+    ('jwt', 'verify_decode_jwt'),
+    ('permission', 'check_permission'),
+    ('queue', 'admission queue'),
+    ('db', 'SQL'),
+    ('serialize', 'serialization'),
+    ('compress', 'compression')
+)
+
+
+def record(name, seconds):
+    if not has_request_context():
+        return
+    timings = g.setdefault('timings', {})
+    total, count = timings.get(name, (0.0, 0))
+    timings[name] = (total + seconds, count + 1)
+
+
+@contextmanager
+def timed(name, histogram=None, **labels):
+    """Time the block as step ``name`` of the current request, and observe
+    it in ``histogram`` if given."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record(name, elapsed)
+        if histogram is not None:
+            histogram.observe(elapsed, **labels)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, '_query_start', None)
+    if start is not None:
+        record('db', time.perf_counter() - start)
+
+
+def server_timing(timings, total):
+    entries = []
+    for name, description in STEPS:
+        if name in timings:
+            seconds, count = timings[name]
+            if count > 1:
+                description = '%d x %s' % (count, description)
+            entries.append('%s;dur=%.3f;desc="%s"' % (
+                name, seconds * 1000, description))
+    entries.append('total;dur=%.3f' % (total * 1000))
+    return ', '.join(entries)
+
+
+def init_timing(app):
+    # Listening on the Engine class covers the primary and the replicas
+    for name, listener in (('before_cursor_execute', before_cursor_execute),
+                           ('after_cursor_execute', after_cursor_execute)):
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.timings = {}
+
+    @app.after_request
+    def stop_timer(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        timings = g.get('timings', {})
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        request_seconds.observe(total, method=request.method, route=route,
+                                status=str(response.status_code))
+        query_seconds, queries = timings.get('db', (0.0, 0))
+        request_queries.observe(queries, route=route)
+        request_query_seconds.observe(query_seconds, route=route)
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = server_timing(timings, total)
+        return response
@@ -0,0 +1,7 @@
+# WSGI entry point, serve with:
+#   gunicorn wsgi:app
+# The app is only built here, so importing app or models has no side
+# effects.
+from app import create_app
+
+app = create_app()